@@ -4,17 +4,21 @@
 #  Import Libraries  #
 #######################
 
-from osgeo import ogr, gdal
-import rasterio as rio
-from rasterio.mask import mask
-import geopandas as gpd
 import numpy as np
-from shapely.geometry import box
+import os
+import re
 import json
+import math
+import glob
+import hashlib
+import shutil
+import time
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
-# May use in def ras2shp_extent
-import fiona
-from fiona.crs import from_epsg
+# GDAL (osgeo), fiona, rasterio, pandas, geopandas and shapely are only imported by the functions that use them,
+# so importing this module and starting the worker processes stays fast
 
 
 #######################
@@ -22,88 +26,77 @@ from fiona.crs import from_epsg
 #######################
 
 
-# This will organize the different amenities into a group
-def amen_group(string):
-    # input arrays here for the different amenities
-    food = ['bar', 'biergarten', 'cafe', 'drinking_water', 'fast_food',
-            'food_court', 'ice_cream', 'pub', 'restaurant']
-
-    education = ['college', 'driving_school', 'kindergarten', 'language_school',
-                 'library', 'toy_library', 'music_school', 'school', 'university']
+# The different amenities of each amenity group, in the order amen_group searches them
+amenity_groups = {
+    'food': ('bar', 'biergarten', 'cafe', 'drinking_water', 'fast_food',
+             'food_court', 'ice_cream', 'pub', 'restaurant'),
 
-    transportation = ['bicycle_parking', 'bicycle_repair_station', 'bicycle_rental',
-                      'boat_rental', 'boat_sharing', 'bus_station', 'car_rental',
-                      'car_sharing', 'car_wash', 'vehicle_inspection', 'charging_station',
-                      'ferry_terminal', 'fuel', 'grit_bin', 'motorcycle_parking',
-                      'parking', 'parking_entrance', 'parking_space', 'taxi', 'kick-scooter_rental']
+    'education': ('college', 'driving_school', 'kindergarten', 'language_school',
+                  'library', 'toy_library', 'music_school', 'school', 'university'),
 
-    financial = ['atm', 'bank', 'bureau_de_change']
+    'transportation': ('bicycle_parking', 'bicycle_repair_station', 'bicycle_rental',
+                       'boat_rental', 'boat_sharing', 'bus_station', 'car_rental',
+                       'car_sharing', 'car_wash', 'vehicle_inspection', 'charging_station',
+                       'ferry_terminal', 'fuel', 'grit_bin', 'motorcycle_parking',
+                       'parking', 'parking_entrance', 'parking_space', 'taxi', 'kick-scooter_rental'),
 
-    healthcare = ['baby_hatch', 'clinic', 'dentist', 'doctors', 'hospital', 'nursing_home',
-                  'pharmacy', 'social_facility', 'veterinary']
+    'financial': ('atm', 'bank', 'bureau_de_change'),
 
-    entertainment = ['arts_centre', 'brothel', 'casino', 'cinema', 'community_centre',
-                     'conference_centre', 'events_venue', 'fountain', 'gambling',
-                     'love_hotel', 'nightclub', 'planetarium', 'public_bookcase',
-                     'social_centre', 'stripclub', 'studio', 'swingerclub', 'theatre']
+    'healthcare': ('baby_hatch', 'clinic', 'dentist', 'doctors', 'hospital', 'nursing_home',
+                   'pharmacy', 'social_facility', 'veterinary'),
 
-    others = ['animal_boarding', 'animal_breeding', 'animal_shelter', 'baking_oven',
-              'childcare', 'clock', 'crematorium', 'dive_centre',
-              'funeral_hall', 'grave_yard', 'gym', 'hunting_stand',
-              'internet_cafe', 'kitchen', 'kneipp_water_cure', 'lounger', 'marketplace',
-              'monastery', 'photo_booth', 'place_of_mourning', 'place_of_worship', 'public_bath',
-              'public_building', 'refugee_site', 'vending_machine', 'user defined']
+    'entertainment': ('arts_centre', 'brothel', 'casino', 'cinema', 'community_centre',
+                      'conference_centre', 'events_venue', 'fountain', 'gambling',
+                      'love_hotel', 'nightclub', 'planetarium', 'public_bookcase',
+                      'social_centre', 'stripclub', 'studio', 'swingerclub', 'theatre'),
 
-    public_service = ['courthouse', 'embassy', 'fire_station', 'police', 'post_box', 'post_depot',
-                      'post_office', 'prison', 'ranger_station', 'townhall']
+    'others': ('animal_boarding', 'animal_breeding', 'animal_shelter', 'baking_oven',
+               'childcare', 'clock', 'crematorium', 'dive_centre',
+               'funeral_hall', 'grave_yard', 'gym', 'hunting_stand',
+               'internet_cafe', 'kitchen', 'kneipp_water_cure', 'lounger', 'marketplace',
+               'monastery', 'photo_booth', 'place_of_mourning', 'place_of_worship', 'public_bath',
+               'public_building', 'refugee_site', 'vending_machine', 'user defined'),
 
-    facilities = ['bbq', 'bench', 'dog_toilet', 'give_box', 'shelter', 'shower', 'telephone',
-                  'toilets', 'water_point', 'watering_place']
+    'public_service': ('courthouse', 'embassy', 'fire_station', 'police', 'post_box', 'post_depot',
+                       'post_office', 'prison', 'ranger_station', 'townhall'),
 
-    waste_man = ['sanitary_dump_station', 'recycling', 'waste_basket', 'waste_disposal',
-                 'waste_transfer_station']
+    'facilities': ('bbq', 'bench', 'dog_toilet', 'give_box', 'shelter', 'shower', 'telephone',
+                   'toilets', 'water_point', 'watering_place'),
 
-    # go through the different functions
-    # which should return the right thing
-    for x in food:
-        if x.__contains__(string):
-            return 'food'
+    'waste_management': ('sanitary_dump_station', 'recycling', 'waste_basket', 'waste_disposal',
+                         'waste_transfer_station'),
+}
 
-    for x in education:
-        if x.__contains__(string):
-            return 'education'
+# Every (amenity, amenity group) pair in search order and the exact amenity -> amenity group lookup
+amenity_search = [(amenity, group) for group, amenities in amenity_groups.items() for amenity in amenities]
+amenity_lookup = {amenity: group for amenity, group in reversed(amenity_search)}
 
-    for x in transportation:
-        if x.__contains__(string):
-            return 'transportation'
 
-    for x in financial:
-        if x.__contains__(string):
-            return 'financial'
-
-    for x in healthcare:
-        if x.__contains__(string):
-            return 'healthcare'
+# This will organize the different amenities into a group.
+# The amenity is matched when it is part of an amenity name of a group (e.g. 'park' is 'transportation')
+# and the first group that matches is returned. None is returned if no group matches
+def amen_group(string):
+    for amenity, group in amenity_search:
+        if amenity.__contains__(string):
+            return group
 
-    for x in entertainment:
-        if x.__contains__(string):
-            return 'entertainment'
 
-    for x in others:
-        if x.__contains__(string):
-            return 'others'
+# Vectorized amen_group for a whole column of amenities.
+# Each distinct amenity is only classified once and the groups are returned as a categorical Series.
+# substring=True reproduces amen_group exactly. substring=False only uses exact amenity names with amenity_lookup
+def classify_amenities(amenity, substring=True):
+    import pandas as pd
 
-    for x in public_service:
-        if x.__contains__(string):
-            return 'public_service'
+    amenity = pd.Series(amenity)
+    categories = pd.CategoricalDtype(list(amenity_groups))
 
-    for x in facilities:
-        if x.__contains__(string):
-            return 'facilities'
+    if substring:
+        unique = amenity.dropna().unique()
+        lookup = {value: amen_group(value) for value in unique}
+    else:
+        lookup = amenity_lookup
 
-    for x in waste_man:
-        if x.__contains__(string):
-            return 'waste_management'
+    return amenity.map(lookup).astype(categories)
 
 
 # Need to get coordinates of the geometry in JSON format for Rasterio.
@@ -116,55 +109,82 @@ def getFeatures(gdf):
 # This is to use clip a raster to the extent of the flood map shapefile
 # that is assumed to be at the extent the user wants.
 # It is also assumed that the input_shapefile already had gpd.read_file(input_shapefile) executed
-def ras2shp_extent(input_rasterfile, input_shapefile, output_rasterfile):
-    # open raster file using rio
-    crop = rio.open(input_rasterfile)
+# Only the window of the raster covering the extent is read (rounded outward to whole pixels).
+# Returns the clipped array (bands, rows, columns) and its transform.
+# The clipped raster is only saved to disk when output_rasterfile is given.
+# With memmap_store=True (or the directory of the store) the window is sliced from the memory-mapped exposure store
+# of the first band of the raster (see exposure_store) without decoding the raster
+def ras2shp_extent(input_rasterfile, input_shapefile, output_rasterfile=None, memmap_store=False):
+    import rasterio as rio
+    from rasterio.windows import transform as window_transform
+
+    if memmap_store:
+        store = exposure_store(input_rasterfile, memmap_store if isinstance(memmap_store, str) else None)
+        window = store_window(store, input_shapefile)
+        rows, cols = window.toslices()
+
+        # The slice is a view of the store so nothing is copied
+        out_img = store['array'][np.newaxis, rows, cols]
+        out_transform = window_transform(window, store['transform'])
+
+        if output_rasterfile is not None:
+            with rio.open(output_rasterfile, "w", driver="GTiff", height=out_img.shape[1], width=out_img.shape[2],
+                          count=1, dtype=out_img.dtype, crs=store['crs'], transform=out_transform,
+                          nodata=store['nodata']) as dest:
+                dest.write(out_img)
+
+        return out_img, out_transform
 
-    # Gather the extent of the flood map
-    bounds = input_shapefile.total_bounds
+    # open raster file using rio
+    with rio.open(input_rasterfile) as crop:
+        # Pixel window of the extent of the flood map projected into the same CRS as the grid
+        window = flood_window(crop, input_shapefile)
 
-    # Get shapefile Coordinate Reference System (crs)
-    fld_crs = str(input_shapefile.crs)
+        # Read only the window of the raster
+        out_img = crop.read(window=window)
+        out_transform = crop.window_transform(window)
 
-    # Load extent into bounding box
-    bbox = box(bounds[-4], bounds[-3], bounds[-2], bounds[-1])
+        # Copy the metadata
+        out_meta = crop.meta.copy()
 
-    # Create a GeoDataFrame from the bounding box
-    # geo = gpd.GeoDataFrame({'geometry': bbox}, index=[0], crs=from_epsg(4326))
-    geo = gpd.GeoDataFrame({'geometry': bbox}, index=[0], crs=fld_crs)
+    if output_rasterfile is not None:
+        # update metadata
+        out_meta.update({"driver": "GTiff",
+                         "height": out_img.shape[1],
+                         "width": out_img.shape[2],
+                         "transform": out_transform}
+                        )
 
-    # Project the Polygon into same CRS as the grid
-    geo = geo.to_crs(crs=crop.crs)
+        # Save the clipped raster to disk
+        with rio.open(output_rasterfile, "w", **out_meta) as dest:
+            dest.write(out_img)
 
-    # Get the geometry coordinates by using the function above
-    coords = getFeatures(geo)
+    return out_img, out_transform
 
-    # Clip the raster with the polygon
-    out_img, out_transform = mask(dataset=crop, shapes=coords, crop=True)
 
-    # Copy the metadata
-    out_meta = crop.meta.copy()
+# Pixel windows (xoff, yoff, xsize, ysize) that follow the native blocks of a GDAL band.
+# Striped rasters have blocks of only one or a few full rows so those blocks are grouped
+# into windows of at least block_rows rows
+def band_windows(band, block_rows=256):
+    xblock, yblock = band.GetBlockSize()
+    if xblock >= band.XSize:
+        yblock = max(yblock, (block_rows // yblock) * yblock)
 
-    # Define the new projection as the same as the flood map
-    # floodmap_crs = str(flood_map.crs)
-    new_crs = {'init': fld_crs}
+    for yoff in range(0, band.YSize, yblock):
+        for xoff in range(0, band.XSize, xblock):
+            yield xoff, yoff, min(xblock, band.XSize - xoff), min(yblock, band.YSize - yoff)
 
-    # update metadata
-    out_meta.update({"driver": "GTiff",
-                     "height": out_img.shape[1],
-                     "width": out_img.shape[2],
-                     "transform": out_transform,
-                     "crs": new_crs}
-                    )
 
-    # Save the clipped raster to disk
-    out_tif = output_rasterfile
+# Reclassify one GDAL band into another one block at a time (see reclass_raster for the arguments)
+def reclass_band(band, band2, arg1, val1, optional_arg2=0, optional_val2=0):
+    for xoff, yoff, xsize, ysize in band_windows(band):
+        clist = band.ReadAsArray(xoff, yoff, xsize, ysize)
 
-    with rio.open(out_tif, "w", **out_meta) as dest:
-        dest.write(out_img)
+        # reclassify everything to 0 that is not cell value 2 (meaning agriculture)
+        clist[clist >= arg1] = val1
+        clist[clist < optional_arg2] = optional_val2
 
-    # Close raster file
-    crop.close()
+        band2.WriteArray(clist, xoff, yoff)
 
 
 # This takes a single band raster and reclassifies it into two different values.
@@ -173,44 +193,95 @@ def ras2shp_extent(input_rasterfile, input_shapefile, output_rasterfile):
 # arg1 and val1 work as such: raster values >= arg1 will become val1
 # optional_arg2 and optional_val2 is performed after the first argument and value and work as such:
 #           # raster values < optional_arg2 will become optional_val2. The default's are 0 and 0
+# The raster is read, reclassified and written one block at a time (see band_windows)
+# so the memory used depends on the block size and not the raster size
 def reclass_raster(input_file, out_file, arg1, val1, optional_arg2=0, optional_val2=0):
+    from osgeo import gdal
+
     # load various gdal input
     driver = gdal.GetDriverByName('GTiff')
     file = gdal.Open(input_file)
     band = file.GetRasterBand(1)
-    clist = band.ReadAsArray()
 
-    # reclassify everything to 0 that is not cell value 2 (meaning agriculture)
-    clist = np.where(clist >= arg1, val1, clist)
-    clist = np.where(clist < optional_arg2, optional_val2, clist)
-
-    # create new file
-    file2 = driver.Create(out_file, file.RasterXSize, file.RasterYSize, 1)
-    file2.GetRasterBand(1).WriteArray(clist)
+    # create new tiled file so it can be written block by block
+    file2 = driver.Create(out_file, file.RasterXSize, file.RasterYSize, 1, gdal.GDT_Byte,
+                          ['TILED=YES', 'BIGTIFF=IF_SAFER'])
+    band2 = file2.GetRasterBand(1)
 
     # spatial ref system
     proj = file.GetProjection()
     georef = file.GetGeoTransform()
     file2.SetProjection(proj)
     file2.SetGeoTransform(georef)
+
+    reclass_band(band, band2, arg1, val1, optional_arg2, optional_val2)
+
     file2.FlushCache()
     del file2
 
 
 # This takes a single band raster and converts all raster cell values of 0 to be noData
 def ras_Null(input_file, output_file, null_value):
+    from osgeo import gdal
+
     ds = gdal.Open(input_file)
     ds = gdal.Translate(output_file, ds, noData=null_value)
     ds = None
 
 
+# Polygonize a GDAL raster into an OGR layer one strip of block_rows full rows at a time.
+# Each strip is copied into an in-memory dataset so only one strip is held in memory.
+# Only the cells that are not noData are traced.
+# Note: a polygon that crosses the edge between two strips is split into one polygon per strip
+def polygonize_strips(raster, outlayer, block_rows):
+    from osgeo import gdal
+
+    band = raster.GetRasterBand(1)
+    nodata = band.GetNoDataValue()
+    x0, dx, rx, y0, ry, dy = raster.GetGeoTransform()
+    mem = gdal.GetDriverByName('MEM')
+
+    for yoff in range(0, raster.RasterYSize, block_rows):
+        rows = min(block_rows, raster.RasterYSize - yoff)
+
+        # Strip dataset with the origin moved down to its first row
+        strip = mem.Create('', raster.RasterXSize, rows, 1, band.DataType)
+        strip.SetGeoTransform((x0 + yoff * rx, dx, rx, y0 + yoff * dy, ry, dy))
+        strip_band = strip.GetRasterBand(1)
+        strip_band.WriteArray(band.ReadAsArray(0, yoff, raster.RasterXSize, rows))
+        if nodata is not None:
+            strip_band.SetNoDataValue(nodata)
+
+        gdal.Polygonize(strip_band, strip_band.GetMaskBand(), outlayer, 0, [])
+        strip = None
+
+
+# Dissolve flood polygons into a single multipolygon per 'Value' and/or simplify them.
+# simplify=True simplifies with a tolerance of one pixel (pixel_size) and a number is the tolerance in the CRS units
+def generalize_flood_map(fld_map, dissolve=False, simplify=False, pixel_size=None):
+    if dissolve:
+        fld_map = fld_map.dissolve(by='Value', as_index=False)
+
+    if simplify is not False:
+        tolerance = pixel_size if simplify is True else simplify
+        fld_map = fld_map.set_geometry(fld_map.geometry.simplify(tolerance))
+
+    return fld_map
+
+
 # This takes a single band raster and converts it to a polygon shapefile.
-# This makes all noData values to be 0
-# To rectify this, open the output_file as a geopandas dataframe and delete all rows with Value of 0.
-# We then save the dataframe back to the output_file shapefile
-def ras2poly(input_file, output_file, nan_value):
-    # read raster in rasterio to get crs
-    crs = str(rio.open(input_file).crs)
+# Only the cells that are not noData are traced using the validity mask of the band.
+# If the raster has no noData value then nan_value is used as the noData value
+# and any polygons with a Value of nan_value are deleted from the shapefile.
+# The shapefile has the same projection as the raster.
+# With block_rows the raster is polygonized in strips of that many rows (see polygonize_strips)
+# so the memory used depends on block_rows and not the raster size.
+# dissolve=True makes a single multipolygon and simplify=True simplifies the polygons by one pixel
+# (or a number for the tolerance in the raster CRS units), see generalize_flood_map.
+# The invalid polygons are repaired first (see repair_geometries)
+def ras2poly(input_file, output_file, nan_value, block_rows=None, dissolve=False, simplify=False):
+    import geopandas as gpd
+    from osgeo import ogr, gdal
 
     # read in raster using gdal
     raster = gdal.Open(input_file)
@@ -218,40 +289,1991 @@ def ras2poly(input_file, output_file, nan_value):
     # get raster band
     band = raster.GetRasterBand(1)
 
-    # set gdal options
+    # Use nan_value as the noData value through a virtual raster without copying any cells
+    if band.GetNoDataValue() is None:
+        raster = gdal.Translate('', raster, format='VRT', noData=nan_value)
+        band = raster.GetRasterBand(1)
+
+    # set gdal options. Make flood map .shp in same projection as the flood map .tif
     drv = ogr.GetDriverByName('ESRI Shapefile')
     outfile = drv.CreateDataSource(output_file)
-    outlayer = outfile.CreateLayer('polygonized raster', srs=None)
+    outlayer = outfile.CreateLayer('polygonized raster', srs=raster.GetSpatialRef())
     newField = ogr.FieldDefn('Value', ogr.OFTReal)
     outlayer.CreateField(newField)
 
-    # use gdal raster to polygon procedure
-    gdal.Polygonize(band, None, outlayer, 0, [])
+    # use gdal raster to polygon procedure on the valid (flooded) cells
+    if block_rows is None:
+        gdal.Polygonize(band, band.GetMaskBand(), outlayer, 0, [])
+    else:
+        polygonize_strips(raster, outlayer, block_rows)
+
+    # Delete the polygons that are of value nan_value without loading the shapefile
+    outlayer.SetAttributeFilter('Value = %s' % nan_value)
+    fids = [feature.GetFID() for feature in outlayer]
+    outlayer.SetAttributeFilter(None)
+    for fid in fids:
+        outlayer.DeleteFeature(fid)
+
+    # Remove the deleted polygons from the shapefile on disk
+    if fids:
+        outfile.ExecuteSQL('REPACK ' + outlayer.GetName())
     outfile = None
 
-    # load as a geopandas dataframe
-    fld_map = gpd.read_file(output_file)
+    if dissolve or simplify is not False:
+        # Polygonize can make invalid rings, which dissolve cannot union, so they are fixed first
+        fld_map, n_fixed = repair_geometries(gpd.read_file(output_file))
+        fld_map = generalize_flood_map(fld_map, dissolve, simplify, abs(raster.GetGeoTransform()[1]))
+        fld_map.to_file(output_file)
+
+
+# Using Shapely to see if the geometries of a GeoDataFrame are valid and fix all of the invalid ones at once.
+# method='buffer' buffers them by (0). method='make_valid' uses make_valid and only keeps the polygon parts.
+# Returns the fixed GeoDataFrame and the number of geometries that were fixed
+def repair_geometries(fld_map, method='buffer'):
+    geoms = fld_map.geometry
+    invalid = (~geoms.is_valid & geoms.notna()).to_numpy()
+    n_fixed = int(invalid.sum())
 
-    # Delete rows that are of value 'nan' in Amenity column
-    fld_map = fld_map[fld_map.Value != nan_value]
+    if n_fixed == 0:
+        return fld_map, 0
 
-    # Make flood map .shp in same projection as the flood map .tif
-    fld_map.crs = {'init': crs}
+    if method == 'make_valid':
+        fixed = geoms[invalid].make_valid()
 
-    # Writes as point shape file
-    fld_map.to_file(output_file)
+        # make_valid returns lines, points or collections with them where rings collapsed.
+        # Buffering them by (0) keeps only their polygon parts (an empty polygon when there are none)
+        other = ~fixed.geom_type.isin(['Polygon', 'MultiPolygon']).to_numpy()
+        fixed[other] = fixed[other].buffer(0)
+    else:
+        fixed = geoms[invalid].buffer(0)
+
+    # Replace only the invalid geometries
+    values = geoms.values.copy()
+    values[invalid] = fixed.values
+
+    return fld_map.set_geometry(values), n_fixed
 
 
 # Using Shapely to see if the new shapefile .is_valid. If it is not the buffer by (0) to fix the geometry
-def fix_geometries(input_file):
+# Returns the number of geometries that were fixed
+def fix_geometries(input_file, method='buffer'):
+    import geopandas as gpd
+
     # Read in the .shp file as a geopandas dataframe
     fld_map = gpd.read_file(input_file)
 
-    # Iterate through the rows to see if it is valid
-    for invalid_row in fld_map[~fld_map.is_valid].iterrows():
-        # where invalid_row[0] is the index in flood_maps of the invalid row
-        # invalid_row[1] is the row from the flood_maps geodataframe
-        fld_map.loc[invalid_row[0], 'geometry'] = invalid_row[1].geometry.buffer(0)
+    # Fix the invalid geometries
+    fld_map, n_fixed = repair_geometries(fld_map, method)
 
     # Load up the fixed geometry of the .shp file to the same file
-    fld_map.to_file(input_file)
\ No newline at end of file
+    if n_fixed:
+        fld_map.to_file(input_file)
+
+    return n_fixed
+
+
+# Convert a flood map raster into flood polygons in memory.
+# This is reclass_raster -> ras_Null -> ras2poly -> fix_geometries -> reprojection to epsg (EPSG:4326 by default)
+# chained through an in-memory (MEM) raster and an in-memory OGR layer, so nothing is written to the temp folder.
+# The reclass arguments work the same as reclass_raster and cells of null_value are not flooded.
+# Only the flooded (not null_value) cells are traced. dissolve and simplify work the same as ras2poly.
+# Returns the flood polygons as a GeoDataFrame with a 'Value' column. They are also written once to output_file if given
+def raster2flood_map(input_file, output_file=None, arg1=1, val1=1, optional_arg2=1, optional_val2=0,
+                     null_value=0, epsg=4326, dissolve=False, simplify=False):
+    import geopandas as gpd
+    from osgeo import ogr, gdal
+
+    raster = gdal.Open(input_file)
+    band = raster.GetRasterBand(1)
+
+    # Reclassify into an in-memory raster with the noData value set
+    mem = gdal.GetDriverByName('MEM').Create('', raster.RasterXSize, raster.RasterYSize, 1, gdal.GDT_Byte)
+    mem.SetProjection(raster.GetProjection())
+    mem.SetGeoTransform(raster.GetGeoTransform())
+    mem_band = mem.GetRasterBand(1)
+    mem_band.SetNoDataValue(null_value)
+    reclass_band(band, mem_band, arg1, val1, optional_arg2, optional_val2)
+
+    # use gdal raster to polygon procedure into an in-memory layer
+    layer_ds = ogr.GetDriverByName('Memory').CreateDataSource('')
+    layer = layer_ds.CreateLayer('polygonized raster', srs=raster.GetSpatialRef())
+    layer.CreateField(ogr.FieldDefn('Value', ogr.OFTReal))
+    gdal.Polygonize(mem_band, mem_band.GetMaskBand(), layer, 0, [])
+
+    # Load the polygons that are not null_value into a GeoDataFrame
+    values = []
+    wkbs = []
+    for feature in layer:
+        if feature.GetField('Value') != null_value:
+            values.append(feature.GetField('Value'))
+            wkbs.append(bytes(feature.GetGeometryRef().ExportToWkb()))
+
+    fld_map = gpd.GeoDataFrame({'Value': values}, geometry=gpd.GeoSeries.from_wkb(wkbs),
+                               crs=raster.GetProjection() or None)
+
+    # Ocassionally the geometries are not valid so fix geometries
+    fld_map, n_fixed = repair_geometries(fld_map)
+    fld_map = generalize_flood_map(fld_map, dissolve, simplify, abs(raster.GetGeoTransform()[1]))
+
+    # Since the exposure datasets are in EPSG:4326, force the flood map to be same projection
+    if fld_map.crs != "EPSG:%s" % epsg:
+        fld_map = fld_map.to_crs(epsg=epsg)
+
+    if output_file is not None:
+        fld_map.to_file(output_file)
+
+    return fld_map
+
+
+#######################
+#  Zonal Statistics   #
+#######################
+
+# These functions sum an exposure raster directly under the flood polygons.
+# The flood polygons are rasterized onto the raster grid so nothing is written to disk
+# and no point geometries are created for the raster cells.
+
+
+# Gather the flood polygon geometries in the Coordinate Reference System (crs) of a raster dataset.
+# With bounds (in crs) the bounds are transformed into the CRS of the flood map and only the polygons
+# within them are reprojected, instead of reprojecting every polygon of the flood map.
+# With column, (geometry, value) pairs are returned from the smallest to the largest value of the column so that
+# the largest value is burned last where polygons overlap. Polygons without a value get -inf
+def flood_shapes(flood_map, crs, bounds=None, column=None):
+    from rasterio.warp import transform_bounds
+    import pandas as pd
+
+    if flood_map.crs != crs:
+        if bounds is not None:
+            minx, miny, maxx, maxy = transform_bounds(crs, flood_map.crs, *bounds)
+            flood_map = flood_map.cx[minx:maxx, miny:maxy]
+
+        flood_map = flood_map.to_crs(crs)
+
+    if column is None:
+        return [geom for geom in flood_map.geometry if geom is not None and not geom.is_empty]
+
+    values = flood_map[column].astype(float) if column in flood_map else pd.Series(np.nan, index=flood_map.index)
+    values = values.fillna(-np.inf).to_numpy()
+    order = np.argsort(values, kind='stable')
+
+    return [(geom, value) for geom, value in zip(flood_map.geometry.iloc[order], values[order])
+            if geom is not None and not geom.is_empty]
+
+
+# Gather the pixel window of a grid that covers bounds given in the same CRS as the grid.
+# The window is rounded outward to whole pixels and limited to the extent of the grid.
+# A flood map without any features has nan bounds (inf once transformed), which gives an empty window
+def bounds_window(bounds, transform, width, height):
+    from rasterio.windows import Window, from_bounds
+
+    if not np.all(np.isfinite(bounds)):
+        return Window(0, 0, 0, 0)
+
+    window = from_bounds(*bounds, transform=transform)
+
+    # Round outward so that every pixel touched by the extent is included
+    col_start = max(math.floor(window.col_off), 0)
+    row_start = max(math.floor(window.row_off), 0)
+    col_stop = min(math.ceil(window.col_off + window.width), width)
+    row_stop = min(math.ceil(window.row_off + window.height), height)
+
+    return Window(col_start, row_start, max(col_stop - col_start, 0), max(row_stop - row_start, 0))
+
+
+# Union of the extents of flood maps in another CRS (EPSG:4326 by default) as (minx, miny, maxx, maxy).
+# Flood maps without any features are skipped. Returns None when none of the flood maps has features
+def flood_bounds(flood_maps, crs="EPSG:4326"):
+    from rasterio.warp import transform_bounds
+
+    bounds = np.array([transform_bounds(flood_map.crs, crs, *flood_map.total_bounds) for flood_map in flood_maps
+                       if np.all(np.isfinite(flood_map.total_bounds))]).reshape(-1, 4)
+    if len(bounds) == 0:
+        return None
+
+    return bounds[:, 0].min(), bounds[:, 1].min(), bounds[:, 2].max(), bounds[:, 3].max()
+
+
+# Gather the pixel window of an open rasterio dataset that covers the extent of the flood map
+def flood_window(src, flood_map):
+    from rasterio.warp import transform_bounds
+
+    # Project the extent of the flood map into the same CRS as the grid
+    bounds = transform_bounds(flood_map.crs, src.crs, *flood_map.total_bounds)
+
+    return bounds_window(bounds, src.transform, src.width, src.height)
+
+
+# Rasterize the flood polygons onto a grid. A cell is flooded when its center is inside a polygon,
+# which is the same test gpd.clip does with the raster-to-point data
+def flood_mask(shapes, out_shape, transform):
+    from rasterio.features import rasterize
+
+    if len(shapes) == 0 or 0 in out_shape:
+        return np.zeros(out_shape, dtype=bool)
+
+    burned = rasterize(shapes, out_shape=out_shape, transform=transform,
+                       fill=0, default_value=1, dtype='uint8')
+
+    return burned.astype(bool)
+
+
+# Labels of the cells and blocks of the flood coverage of a grid (see flood_coverage)
+coverage_outside = 0
+coverage_inside = 1
+coverage_partial = 2
+
+# Number of rows and columns of cells in each block of the flood coverage of a grid
+coverage_block = 16
+
+
+# Blocks of block x block cells of a grid that have at least one cell marked in cells (the last row and column
+# of blocks only have the cells left in the grid)
+def marked_blocks(cells, block=coverage_block):
+    height, width = -(-cells.shape[0] // block), -(-cells.shape[1] // block)
+    padded = np.pad(cells, ((0, height * block - cells.shape[0]), (0, width * block - cells.shape[1])))
+
+    return padded.reshape(height, block, width, block).any(axis=(1, 3))
+
+
+# Repeat the values of the blocks of block x block cells for each of their cells of a grid of out_shape
+def block_cells(blocks, out_shape, block=coverage_block):
+    return np.repeat(np.repeat(blocks, block, axis=0), block, axis=1)[:out_shape[0], :out_shape[1]]
+
+
+# Pixel windows of a grid that cover the partial blocks of the flood coverage of a grid.
+# Each row of blocks is cut to the columns from its first to its last partial block and rows of blocks next to
+# each other are joined into one window as long as it has at most about 4 million samples when supersampled.
+# Rows of blocks that are all inside or outside are skipped
+def partial_windows(partial_blocks, out_shape, supersample, block=coverage_block):
+    from rasterio.windows import Window
+
+    height, width = out_shape
+    max_cells = max(2 ** 22 // supersample ** 2, block * block)
+
+    windows = []
+    group = None
+    for block_row in range(partial_blocks.shape[0]):
+        partial_cols = np.flatnonzero(partial_blocks[block_row])
+        if len(partial_cols) == 0:
+            continue
+
+        row_start, row_stop = block_row * block, min((block_row + 1) * block, height)
+        col_start, col_stop = partial_cols[0] * block, min((partial_cols[-1] + 1) * block, width)
+
+        if group is not None and group[1] == row_start:
+            joined = (group[0], row_stop, min(group[2], col_start), max(group[3], col_stop))
+            if (joined[1] - joined[0]) * (joined[3] - joined[2]) <= max_cells:
+                group = joined
+                continue
+
+        if group is not None:
+            windows.append(group)
+        group = (row_start, row_stop, col_start, col_stop)
+
+    if group is not None:
+        windows.append(group)
+
+    return [Window(int(col_start), int(row_start), int(col_stop - col_start), int(row_stop - row_start))
+            for row_start, row_stop, col_start, col_stop in windows]
+
+
+# Rasterize the flood polygons once into coverage labels of the cells and blocks of a grid and the fraction of every
+# cell of the grid that they cover.
+# The cells touched by the boundary of a flood polygon are partial (rasterized with all_touched) and the blocks of
+# block x block cells without a partial cell are fully inside or fully outside of the flood polygons, which is tested
+# at the center of each block. Whole blocks get a fraction of 1 or 0 in bulk and only the blocks with partial cells
+# are rasterized onto a grid supersample times finer in both directions (supersample ** 2 cell-center samples in each
+# cell), a window at a time with only the flood polygons within the window (see partial_windows), which labels
+# their cells that are not partial as inside or outside.
+# With bins the shapes are (geometry, depth) pairs (see flood_shapes) and the fraction of every cell in each depth bin
+# (see depth_bin_index) is returned as well. Where polygons overlap the largest depth is kept.
+# Returns the coverage of the grid: a dictionary with the 'labels' of the cells, the labels of the 'blocks', the depth
+# bin of every block fully inside ('block_bins', -1 for the other blocks), the cells of the partial blocks
+# ('partial'), the 'fraction' covered, a list with the fraction in each bin ('bin_fractions', empty without bins)
+# and the 'block' size (see coverage_sums)
+def flood_coverage(shapes, out_shape, transform, supersample=4, bins=None, block=coverage_block):
+    from rasterio.features import rasterize
+    from rasterio.windows import bounds as window_bounds
+    from rasterio.transform import Affine
+    import geopandas as gpd
+    import shapely
+    from shapely.geometry import box
+
+    height, width = out_shape
+    blocks_shape = (-(-height // block), -(-width // block))
+    coverage = {'labels': np.full(out_shape, coverage_outside, dtype='uint8'),
+                'blocks': np.full(blocks_shape, coverage_outside, dtype='uint8'),
+                'block_bins': np.full(blocks_shape, -1, dtype=np.int64),
+                'partial': np.zeros(out_shape, dtype=bool),
+                'fraction': np.zeros(out_shape, dtype='float32'),
+                'bin_fractions': [np.zeros(out_shape, dtype='float32') for _ in bins] if bins is not None else [],
+                'block': block}
+
+    if len(shapes) == 0 or 0 in out_shape:
+        return coverage
+
+    labels, fraction, bin_fractions = coverage['labels'], coverage['fraction'], coverage['bin_fractions']
+    geoms = gpd.GeoSeries([shape[0] if isinstance(shape, tuple) else shape for shape in shapes])
+    values = np.array([shape[1] if isinstance(shape, tuple) else 1 for shape in shapes], dtype='float32')
+
+    edges = rasterize(geoms.boundary, out_shape=out_shape, transform=transform, fill=0, default_value=1,
+                      all_touched=True, dtype='uint8')
+    labels[edges == 1] = coverage_partial
+
+    # Blocks with a partial cell and the center of the other blocks (limited to the grid)
+    partial_blocks = marked_blocks(edges == 1, block)
+    block_rows, block_cols = np.nonzero(~partial_blocks)
+    center_rows = (block_rows * block + np.minimum((block_rows + 1) * block, height)) / 2
+    center_cols = (block_cols * block + np.minimum((block_cols + 1) * block, width)) / 2
+    centers = shapely.points(*(transform * (center_cols, center_rows)))
+
+    # A block without a partial cell has the largest depth of the polygons that contain its center.
+    # Each polygon is prepared once and only tested against the centers near it
+    in_geom, in_block = shapely.STRtree(centers).query(geoms.values, predicate='contains')
+    block_depth = np.full(partial_blocks.shape, np.nan, dtype='float32')
+    np.fmax.at(block_depth, (block_rows[in_block], block_cols[in_block]), values[in_geom])
+
+    # A block is partial when it has a partial cell and otherwise has the label of its center
+    coverage['blocks'][~np.isnan(block_depth)] = coverage_inside
+    coverage['blocks'][partial_blocks] = coverage_partial
+    if bins is not None:
+        coverage['block_bins'] = depth_bin_index(block_depth, bins)
+
+    is_inside = block_cells(coverage['blocks'] == coverage_inside, out_shape, block)
+    labels[is_inside] = coverage_inside
+    fraction[is_inside] = 1
+
+    for k, bin_fraction in enumerate(bin_fractions):
+        bin_fraction[block_cells(coverage['block_bins'] == k, out_shape, block)] = 1
+
+    sindex = geoms.sindex
+    fine_transform = transform * Affine.scale(1 / supersample)
+    partial_cells = coverage['partial'] = block_cells(partial_blocks, out_shape, block)
+
+    for window in partial_windows(partial_blocks, out_shape, supersample, block):
+        rows, cols = window.toslices()
+
+        # Only the cells of the partial blocks of the window are estimated
+        estimate = partial_cells[rows, cols]
+
+        # Only the flood polygons within the window are rasterized
+        window_index = np.sort(sindex.query(box(*window_bounds(window, transform))))
+        fine_shape = (window.height * supersample, window.width * supersample)
+        strip_transform = fine_transform * Affine.translation(window.col_off * supersample,
+                                                              window.row_off * supersample)
+
+        if bins is None:
+            fine = rasterize(geoms.values[window_index], out_shape=fine_shape, transform=strip_transform,
+                             fill=0, default_value=1, dtype='uint8')
+            means = fine.reshape(window.height, supersample, window.width, supersample).mean(axis=(1, 3))
+        else:
+            fine_depth = rasterize([shapes[i] for i in window_index], out_shape=fine_shape, transform=strip_transform,
+                                   fill=np.nan, dtype='float32')
+            means = (~np.isnan(fine_depth)).reshape(window.height, supersample, window.width,
+                                                    supersample).mean(axis=(1, 3))
+
+            fine_index = depth_bin_index(fine_depth, bins)
+            for k, bin_fraction in enumerate(bin_fractions):
+                bin_means = (fine_index == k).reshape(window.height, supersample, window.width,
+                                                      supersample).mean(axis=(1, 3))
+                bin_fraction[rows, cols][estimate] = bin_means[estimate]
+
+        fraction[rows, cols][estimate] = means[estimate]
+
+        # A cell that is not partial has every sample inside or every sample outside
+        whole = estimate & (labels[rows, cols] != coverage_partial)
+        labels[rows, cols][whole] = np.where(means[whole] == 1, coverage_inside, coverage_outside)
+
+    return coverage
+
+
+# Sum of the values of every block of block x block cells of a grid (the last row and column of blocks only have
+# the cells left in the grid)
+def block_sums(values, block=coverage_block):
+    row_starts = np.arange(0, values.shape[0], block)
+    col_starts = np.arange(0, values.shape[1], block)
+
+    return np.add.reduceat(np.add.reduceat(values, row_starts, axis=0), col_starts, axis=1)
+
+
+# Sum of values (one per cell of a grid, 0 for the cells to leave out) weighted by the flood coverage of the grid
+# (see flood_coverage). The blocks fully inside are summed in bulk, the blocks fully outside are skipped and only
+# the cells of the partial blocks are weighted by the fraction of them that is flooded.
+# Returns the total and a list with the sum in each depth bin (empty without bins)
+def coverage_sums(values, coverage):
+    partial = coverage['partial']
+    partial_values = values[partial]
+    inside = coverage['blocks'] == coverage_inside
+    sums = block_sums(values, coverage['block']) if inside.any() else None
+
+    def weighted(blocks, fraction):
+        total = sums[blocks].sum() if sums is not None else 0.0
+        return float(total + np.dot(partial_values, fraction[partial].astype(np.float64)))
+
+    return (weighted(inside, coverage['fraction']),
+            [weighted(coverage['block_bins'] == k, bin_fraction)
+             for k, bin_fraction in enumerate(coverage['bin_fractions'])])
+
+
+# Read the first band of an exposure raster once for the union of the extents of one or more flood maps.
+# Returns an exposure grid: a dictionary with the masked 'array' (noData is masked) and its 'transform' and 'crs'
+def read_exposure(input_rasterfile, flood_maps):
+    import rasterio as rio
+    from rasterio.windows import Window, union
+
+    with rio.open(input_rasterfile) as src:
+        windows = [flood_window(src, flood_map) for flood_map in flood_maps]
+        windows = [w for w in windows if w.width > 0 and w.height > 0]
+
+        if windows:
+            window = union(*windows)
+            array = src.read(1, window=window, masked=True)
+        else:
+            window = Window(0, 0, 0, 0)
+            array = np.ma.zeros((0, 0), dtype=src.dtypes[0])
+
+        return {'array': array, 'transform': src.window_transform(window), 'crs': src.crs}
+
+
+# Slice the part of an exposure grid covering the flood map.
+# The cropland runs of a grid from read_crop_runs are sliced by window_runs instead of an array.
+# Returns the sliced array (or runs), its transform and its window in the grid
+def grid_window(grid, flood_map):
+    from rasterio.warp import transform_bounds
+    from rasterio.windows import transform as window_transform
+
+    height, width = grid['shape'] if 'runs' in grid else grid['array'].shape
+    bounds = transform_bounds(flood_map.crs, grid['crs'], *flood_map.total_bounds)
+    window = bounds_window(bounds, grid['transform'], width, height)
+    transform = window_transform(window, grid['transform'])
+
+    if 'runs' in grid:
+        return window_runs(grid['runs'], window), transform, window
+
+    # Slicing the shared buffer does not copy any data
+    rows, cols = window.toslices()
+
+    return grid['array'][rows, cols], transform, window
+
+
+# Slice the part of an exposure grid covering the flood map.
+# Returns the sliced array, its transform, and the rasterized flood mask on the same cells
+def grid_flood(grid, flood_map):
+    from rasterio.windows import bounds as window_bounds
+
+    array, transform, window = grid_window(grid, flood_map)
+
+    shapes = flood_shapes(flood_map, grid['crs'], window_bounds(window, grid['transform']))
+    inside = flood_mask(shapes, (window.height, window.width), transform)
+
+    return array, transform, inside
+
+
+# Slice the part of an exposure grid covering the flood map with the fraction of each cell covered by the flood
+# polygons (see flood_coverage). With depth_column and bins the fraction of each cell in each depth bin is added.
+# Returns the sliced array, its transform and its coverage
+def grid_coverage(grid, flood_map, supersample, depth_column=None, bins=None):
+    from rasterio.windows import bounds as window_bounds
+
+    array, transform, window = grid_window(grid, flood_map)
+
+    shapes = flood_shapes(flood_map, grid['crs'], window_bounds(window, grid['transform']), depth_column)
+    coverage = flood_coverage(shapes, (window.height, window.width), transform, supersample, bins)
+
+    return array, transform, coverage
+
+
+# Population of a population grid weighted by the fraction of each cell that is flooded (see coverage_sums).
+# Returns the total and a list with the population of each depth bin of the coverage
+def pop_weighted(pop, coverage):
+    valid = ~np.ma.getmaskarray(pop) & np.isfinite(pop.data)
+
+    return coverage_sums(np.where(valid, pop.data, 0).astype(np.float64), coverage)
+
+
+# Sum of values (a flood mask or fraction on the same cells as crop) over the cells of each row of a croplands grid
+# that are equal to crop_value. crop is a sliced croplands array or the cropland runs from window_runs
+def crop_rows(crop, values, crop_value=2):
+    if isinstance(crop, dict):
+        return runs_rows(crop, values)
+
+    is_crop = (crop.data == crop_value) & ~np.ma.getmaskarray(crop)
+    if values.dtype == bool:
+        return np.count_nonzero(is_crop & values, axis=1)
+
+    return np.where(is_crop, values, 0).sum(axis=1, dtype=np.float64)
+
+
+# Hectares of cropland of a croplands grid weighted by the fraction of each cell that is flooded (see coverage_sums).
+# The cropland runs from window_runs only have the cropland cells already, so they are weighted by the fraction
+# of every cell instead. Returns the total and a list with the hectares of each depth bin of the coverage
+def crop_weighted(crop, coverage, transform, crs, crop_value=2):
+    row_area = cell_area_ha(transform, coverage['fraction'].shape[0], crs)
+
+    if isinstance(crop, dict):
+        return (float(runs_rows(crop, coverage['fraction']) @ row_area),
+                [float(runs_rows(crop, bin_fraction) @ row_area) for bin_fraction in coverage['bin_fractions']])
+
+    is_crop = (crop.data == crop_value) & ~np.ma.getmaskarray(crop)
+
+    return coverage_sums(np.where(is_crop, row_area[:, np.newaxis], 0), coverage)
+
+
+# Total population of a population exposure grid within the flood map.
+# Each cell value is truncated to an integer before summing to match the raster -> point -> clip workflow.
+# With supersample (e.g. 4) each cell is instead weighted by the fraction of it that is flooded (see flood_coverage),
+# which does not undercount or overcount cells along the edges of the flood map
+def pop_sum(grid, flood_map, supersample=None):
+    if supersample is not None:
+        pop, transform, coverage = grid_coverage(grid, flood_map, supersample)
+        return pop_weighted(pop, coverage)[0]
+
+    pop, transform, inside = grid_flood(grid, flood_map)
+
+    # Ignore noData cells the same way georasters drops them when converting to a DataFrame
+    valid = inside & ~np.ma.getmaskarray(pop) & np.isfinite(pop.data)
+
+    return int(np.trunc(pop.data[valid]).astype(np.int64).sum())
+
+
+# Total population of a WorldPop raster within the flood map. Only the pixels covering the flood map are read
+def pop_in_flood(pop_path, flood_map):
+    return pop_sum(read_exposure(pop_path, [flood_map]), flood_map)
+
+
+# Area of one raster cell in hectares for every row of a grid.
+# Geographic grids (e.g. EPSG:4326) use the area of the cell on the WGS84 ellipsoid, which only changes with latitude,
+# so it is computed once per row. Projected grids use the constant pixel size
+def cell_area_ha(transform, height, crs):
+    if crs is None or not crs.is_geographic:
+        return np.full(height, abs(transform.a * transform.e) / 10000)
+
+    # WGS84 semi-major axis (m) and eccentricity
+    a = 6378137.0
+    f = 1 / 298.257223563
+    e = math.sqrt(f * (2 - f))
+    b2 = (a * (1 - f)) ** 2
+
+    # Latitude of the top and bottom edge of each row in radians
+    edges = np.radians(transform.f + transform.e * np.arange(height + 1))
+    sin_lat = np.sin(edges)
+
+    # Authalic function q(lat) so that the area between two latitudes is b^2 * dlon / 2 * |q1 - q2|
+    q = sin_lat / (1 - (e * sin_lat) ** 2) + np.log((1 + e * sin_lat) / (1 - e * sin_lat)) / (2 * e)
+    area_m2 = b2 * abs(math.radians(transform.a)) / 2 * np.abs(np.diff(q))
+
+    return area_m2 / 10000
+
+
+# Total hectares of cropland of a croplands exposure grid within the flood map.
+# Cells equal to crop_value (2 is cultivated agriculture in the croplands dataset) are counted per row under the
+# rasterized flood map and weighted by the area of the cells in that row.
+# With supersample (e.g. 4) each cell is also weighted by the fraction of it that is flooded (see flood_coverage)
+def crop_sum(grid, flood_map, crop_value=2, supersample=None):
+    if supersample is not None:
+        crop, transform, coverage = grid_coverage(grid, flood_map, supersample)
+        return crop_weighted(crop, coverage, transform, grid['crs'], crop_value)[0]
+
+    crop, transform, inside = grid_flood(grid, flood_map)
+
+    # Number of flooded cropland cells in each row
+    row_count = crop_rows(crop, inside, crop_value)
+
+    return float(row_count @ cell_area_ha(transform, inside.shape[0], grid['crs']))
+
+
+# Total hectares of cropland of a croplands raster within the flood map. Only the pixels covering the flood map are read
+def crop_in_flood(croplands_path, flood_map, crop_value=2):
+    return crop_sum(read_exposure(croplands_path, [flood_map]), flood_map, crop_value)
+
+
+#######################
+#   Infrastructure    #
+#######################
+
+# Column names of the impact table for each amenity group returned by amen_group
+amenity_columns = {'education': 'Education', 'entertainment': 'Entertainment', 'facilities': 'Facilities',
+                   'financial': 'Financial', 'food': 'Food', 'healthcare': 'Healthcare', 'others': 'Others',
+                   'public_service': 'Public Service', 'transportation': 'Transportation',
+                   'waste_management': 'Waste Management'}
+
+
+# Prepare the OpenStreetMap points once before intersecting them with any flood map.
+# Only the points with an amenity are kept with their 'Amenity' and 'Amenity_Group' columns
+def prepare_osm(osm_pts):
+    import geopandas as gpd
+
+    # Use a regular expression to extract what the amenity is from the column named 'other_tags'
+    amenity = osm_pts['other_tags'].str.extract('"amenity"=>"(.+?)"', expand=False)
+    has_amenity = amenity.notna().to_numpy()
+
+    osm_pts = gpd.GeoDataFrame({'Amenity': amenity[has_amenity]},
+                               geometry=osm_pts.geometry[has_amenity], crs=osm_pts.crs)
+
+    # Create a new column for the amenity group
+    osm_pts['Amenity_Group'] = classify_amenities(osm_pts['Amenity'])
+
+    return osm_pts.reset_index(drop=True)
+
+
+# Read an OpenStreetMap point shapefile and prepare it with prepare_osm.
+# With cache=True the points come from the GeoParquet cache of cache_osm instead, which is much faster to load.
+# bbox (minx, miny, maxx, maxy in EPSG:4326) only loads the cached points within it
+def read_osm(osm_file, cache=False, bbox=None):
+    import geopandas as gpd
+
+    if cache:
+        return read_osm_cache(cache_osm(osm_file), bbox=bbox)
+
+    return prepare_osm(gpd.read_file(osm_file))
+
+
+# Positions of the points that are within the flood map.
+# The spatial index (STRtree) of the points is built the first time it is used and is kept with the GeoDataFrame,
+# so one index serves every flood map. Each flood polygon is a bounding box query on the index followed by
+# a vectorized intersects predicate on the candidates, which gives the same points as gpd.clip
+def points_in_flood(pts, flood_map):
+    if flood_map.crs != pts.crs:
+        flood_map = flood_map.to_crs(pts.crs)
+
+    geoms = flood_map.geometry[~(flood_map.geometry.isna() | flood_map.geometry.is_empty)]
+    _, pts_idx = pts.sindex.query(geoms.values, predicate='intersects')
+
+    # A point on the shared edge of two flood polygons is only counted once
+    return np.unique(pts_idx)
+
+
+# Gather the OpenStreetMap points from prepare_osm that are within the flood map
+def osm_amenities(osm_pts, flood_map):
+    return osm_pts.iloc[points_in_flood(osm_pts, flood_map)]
+
+
+# Count the flooded OpenStreetMap amenities in each amenity group.
+# Returns a dictionary of impact table column name: count with zero for the groups that are not flooded
+def osm_sum(osm_pts, flood_map):
+    amen_gp_ct = osm_amenities(osm_pts, flood_map)['Amenity_Group'].value_counts()
+
+    return {column: int(amen_gp_ct.get(group, 0)) for group, column in amenity_columns.items()}
+
+
+#######################
+#     Depth Bins      #
+#######################
+
+# These functions break the impact metrics out by the flood depth (or any other attribute) of the flood polygons.
+# The depth is burned onto the exposure grid instead of a constant, so one rasterization gives both
+# the flooded cells and their depth. The totals are the same as pop_sum, crop_sum and osm_sum.
+
+# Lower edges of the depth bins. The last bin has no upper edge (0-0.5 m, 0.5-1 m and >1 m)
+depth_bins = (0, 0.5, 1)
+
+
+# Names of the depth bins (e.g. '0-0.5 m' and '>1 m') added after the impact table column names
+def depth_labels(bins=depth_bins):
+    labels = ['%g-%g m' % (low, high) for low, high in zip(bins[:-1], bins[1:])]
+
+    return labels + ['>%g m' % bins[-1]]
+
+
+# Index of the depth bin of every depth. -1 for depths below the first bin and for no depth (nan or -inf)
+def depth_bin_index(depth, bins=depth_bins):
+    index = np.digitize(depth, bins) - 1
+    index[np.isnan(depth)] = -1
+
+    return index
+
+
+# Slice the part of an exposure grid covering the flood map and rasterize the depth_column of the flood polygons
+# on the same cells. Where polygons overlap the largest depth is kept. Cells that are not flooded are nan and
+# flooded cells of polygons without a depth are -inf. Returns the sliced array, its transform and the depth grid
+def grid_depth(grid, flood_map, depth_column):
+    from rasterio.features import rasterize
+    from rasterio.windows import bounds as window_bounds
+
+    array, transform, window = grid_window(grid, flood_map)
+
+    shape = (window.height, window.width)
+    shapes = flood_shapes(flood_map, grid['crs'], window_bounds(window, grid['transform']), depth_column)
+    if len(shapes) == 0 or 0 in shape:
+        return array, transform, np.full(shape, np.nan, dtype='float32')
+
+    depth = rasterize(shapes, out_shape=shape, transform=transform, fill=np.nan, dtype='float32')
+
+    return array, transform, depth
+
+
+# Total population of a population exposure grid within the flood map and the population in each depth bin.
+# With supersample the cells are weighted by the fraction of them that is flooded in each bin (see pop_sum).
+# Returns the total and a list with the population of each bin
+def pop_depth_sum(grid, flood_map, depth_column, bins=depth_bins, supersample=None):
+    if supersample is not None:
+        pop, transform, coverage = grid_coverage(grid, flood_map, supersample, depth_column, bins)
+        return pop_weighted(pop, coverage)
+
+    pop, transform, depth = grid_depth(grid, flood_map, depth_column)
+
+    valid = ~np.isnan(depth) & ~np.ma.getmaskarray(pop) & np.isfinite(pop.data)
+    people = np.trunc(pop.data[valid]).astype(np.int64)
+    index = depth_bin_index(depth[valid], bins)
+
+    by_bin = np.bincount(index[index >= 0], weights=people[index >= 0], minlength=len(bins))
+
+    return int(people.sum()), by_bin.astype(np.int64).tolist()
+
+
+# Total hectares of cropland of a croplands exposure grid within the flood map and the hectares in each depth bin.
+# With supersample the cells are weighted by the fraction of them that is flooded in each bin (see crop_sum).
+# Returns the total and a list with the hectares of each bin
+def crop_depth_sum(grid, flood_map, depth_column, bins=depth_bins, crop_value=2, supersample=None):
+    if supersample is not None:
+        crop, transform, coverage = grid_coverage(grid, flood_map, supersample, depth_column, bins)
+        return crop_weighted(crop, coverage, transform, grid['crs'], crop_value)
+
+    crop, transform, depth = grid_depth(grid, flood_map, depth_column)
+
+    index = depth_bin_index(depth, bins)
+    row_area = cell_area_ha(transform, depth.shape[0], grid['crs'])
+
+    total = float(crop_rows(crop, ~np.isnan(depth), crop_value) @ row_area)
+    by_bin = [float(crop_rows(crop, index == k, crop_value) @ row_area) for k in range(len(bins))]
+
+    return total, by_bin
+
+
+# Positions of the points that are within the flood map (see points_in_flood) and the largest depth_column value
+# of the flood polygons each point is in (-inf for polygons without a depth)
+def points_depth(pts, flood_map, depth_column):
+    if flood_map.crs != pts.crs:
+        flood_map = flood_map.to_crs(pts.crs)
+
+    keep = ~(flood_map.geometry.isna() | flood_map.geometry.is_empty).to_numpy()
+    if depth_column in flood_map:
+        depth = flood_map[depth_column].astype(float).fillna(-np.inf).to_numpy()[keep]
+    else:
+        depth = np.full(np.count_nonzero(keep), -np.inf)
+
+    flood_idx, pts_idx = pts.sindex.query(flood_map.geometry.values[keep], predicate='intersects')
+
+    # A point in two flood polygons gets the largest depth
+    positions, inverse = np.unique(pts_idx, return_inverse=True)
+    pts_depth = np.full(len(positions), -np.inf)
+    np.maximum.at(pts_depth, inverse, depth[flood_idx])
+
+    return positions, pts_depth
+
+
+# Count the flooded OpenStreetMap amenities in each amenity group and in each depth bin.
+# Returns a dictionary of impact table column name: count (the same as osm_sum)
+# and a dictionary of impact table column name: list with the count of each bin
+def osm_depth_sum(osm_pts, flood_map, depth_column, bins=depth_bins):
+    positions, depth = points_depth(osm_pts, flood_map, depth_column)
+    groups = osm_pts['Amenity_Group'].iloc[positions].to_numpy()
+    index = depth_bin_index(depth, bins)
+
+    totals = {}
+    by_bin = {}
+    for group, column in amenity_columns.items():
+        in_group = groups == group
+        totals[column] = int(np.count_nonzero(in_group))
+        by_bin[column] = [int(np.count_nonzero(in_group & (index == k))) for k in range(len(bins))]
+
+    return totals, by_bin
+
+
+#######################
+#   Batch Processing  #
+#######################
+
+# Compute the impact metrics of one flood map from exposure grids that are already loaded with read_exposure
+# and OpenStreetMap points that are already loaded with read_osm.
+# With depth_column (e.g. 'Depth') every metric is also broken out by the depth bins of depth_bins in the same pass,
+# as extra columns named after the metric and the bin (e.g. 'Population 0-0.5 m').
+# With supersample (e.g. 4) the cropland and population cells are weighted by the fraction of them that is flooded
+# instead of counting the cells whose center is flooded (see flood_coverage).
+# Returns a dictionary of impact table column name: value
+def event_impact(flood_map, crop_grid, pop_grid, osm_pts, crop_value=2, depth_column=None, depth_bins=depth_bins,
+                 supersample=None):
+    if depth_column is None:
+        with profile_stage('croplands sum'):
+            impact = {'Agriculture (ha)': crop_sum(crop_grid, flood_map, crop_value=crop_value,
+                                                   supersample=supersample)}
+        with profile_stage('population sum'):
+            impact['Population'] = pop_sum(pop_grid, flood_map, supersample=supersample)
+        with profile_stage('amenities sum'):
+            impact.update(osm_sum(osm_pts, flood_map))
+
+        return impact
+
+    with profile_stage('croplands sum'):
+        crop_total, crop_bins = crop_depth_sum(crop_grid, flood_map, depth_column, bins=depth_bins,
+                                               crop_value=crop_value, supersample=supersample)
+    with profile_stage('population sum'):
+        pop_total, pop_bins = pop_depth_sum(pop_grid, flood_map, depth_column, bins=depth_bins,
+                                            supersample=supersample)
+    with profile_stage('amenities sum'):
+        osm_totals, osm_bins = osm_depth_sum(osm_pts, flood_map, depth_column, bins=depth_bins)
+
+    impact = {'Agriculture (ha)': crop_total, 'Population': pop_total}
+    impact.update(osm_totals)
+
+    labels = depth_labels(depth_bins)
+    for column, values in [('Agriculture (ha)', crop_bins), ('Population', pop_bins)] + list(osm_bins.items()):
+        impact.update({'%s %s' % (column, label): value for label, value in zip(labels, values)})
+
+    return impact
+
+
+# Compute the impact metrics of many flood maps while reading each exposure dataset only once.
+# flood_maps is a dictionary of flood map name: GeoDataFrame. The croplands and population rasters are read
+# once for the union of the flood map extents and the OpenStreetMap points are read once for all events.
+# With osm_cache=True the OpenStreetMap points within the flood maps are loaded from the cache of cache_osm.
+# tile_cache=True or a directory reads the rasters through the exposure tile cache and memmap_store=True or
+# a directory slices their memory-mapped exposure stores instead (see load_exposure).
+# crop_runs=True or a directory loads the croplands as the cropland runs of the whole raster (see read_crop_runs).
+# depth_column and depth_bins break the metrics out by depth and supersample weights the cells by the fraction
+# of them that is flooded (see event_impact).
+# Returns a DataFrame indexed by flood map name with one column per impact metric
+def batch_impact(flood_maps, croplands_path, pop_path, osm_file, crop_value=2, osm_cache=False, tile_cache=False,
+                 memmap_store=False, depth_column=None, depth_bins=depth_bins, supersample=None, crop_runs=False):
+    import pandas as pd
+
+    maps = list(flood_maps.values())
+
+    # Load each exposure dataset once
+    profiling['flood_map'] = None
+    crop_grid = load_exposure(croplands_path, maps, 'crop', crop_value=crop_value, tile_cache=tile_cache,
+                              memmap_store=memmap_store, crop_runs=crop_runs)
+    pop_grid = load_exposure(pop_path, maps, 'pop', tile_cache=tile_cache, memmap_store=memmap_store)
+    with profile_stage('read amenities'):
+        osm_pts = read_osm(osm_file, cache=osm_cache, bbox=flood_bounds(maps))
+
+    impact = []
+    for name, flood_map in flood_maps.items():
+        profiling['flood_map'] = name
+        impact.append(event_impact(flood_map, crop_grid, pop_grid, osm_pts, crop_value=crop_value,
+                                   depth_column=depth_column, depth_bins=depth_bins, supersample=supersample))
+
+    profiling['flood_map'] = None
+    with profile_stage('aggregate'):
+        return pd.DataFrame(impact, index=list(flood_maps))
+
+
+#######################
+# Parallel Processing #
+#######################
+
+# Load a flood map from a file path or a (geodatabase, layer) tuple.
+# The flood map stays in its own CRS since the impact metrics only reproject the polygons of the flood map
+# within each exposure window (see flood_shapes)
+def read_flood_map(source):
+    import geopandas as gpd
+
+    with profile_stage('read flood map'):
+        if isinstance(source, tuple):
+            return gpd.read_file(source[0], layer=source[1])
+
+        return gpd.read_file(source)
+
+
+# Largest value of each attribute column of the flood map (e.g. 'Depth'). nan if the flood map does not have the column
+def flood_attributes(flood_map, attributes):
+    return {column: flood_map[column].max() if column in flood_map else np.nan for column in attributes}
+
+
+# Exposure datasets loaded once in each worker process by init_worker
+worker_exposure = {}
+
+
+# Runs once when a worker process starts so the OpenStreetMap points are only read and indexed once per worker
+def init_worker(croplands_path, pop_path, osm_file, osm_cache=False, tile_cache=False, memmap_store=False,
+                profile=False, crop_runs=False):
+    profiling['enabled'] = profile
+    worker_exposure['croplands_path'] = croplands_path
+    worker_exposure['pop_path'] = pop_path
+    worker_exposure['tile_cache'] = tile_cache
+    worker_exposure['memmap_store'] = memmap_store
+    worker_exposure['crop_runs'] = crop_runs
+    with profile_stage('read amenities'):
+        worker_exposure['osm_pts'] = read_osm(osm_file, cache=osm_cache)
+
+    # Build the spatial index of the points before the first flood map
+    worker_exposure['osm_pts'].sindex
+
+
+# Compute the impact metrics of one flood map in a worker process.
+# Each worker only reads the windows of the exposure rasters under its flood map (or their tiles from the tile cache).
+# Returns the name, the impact metrics and the stage records of the worker since its last flood map (see profile_stage)
+def worker_impact(name, source, attributes, crop_value, depth_column=None, depth_bins=depth_bins, supersample=None):
+    profiling['flood_map'] = name
+    flood_map = read_flood_map(source)
+    tile_cache = worker_exposure['tile_cache']
+    memmap_store = worker_exposure['memmap_store']
+
+    crop_grid = load_exposure(worker_exposure['croplands_path'], [flood_map], 'crop', crop_value=crop_value,
+                              tile_cache=tile_cache, memmap_store=memmap_store, crop_runs=worker_exposure['crop_runs'])
+    pop_grid = load_exposure(worker_exposure['pop_path'], [flood_map], 'pop', tile_cache=tile_cache,
+                             memmap_store=memmap_store)
+
+    impact = event_impact(flood_map, crop_grid, pop_grid, worker_exposure['osm_pts'], crop_value=crop_value,
+                          depth_column=depth_column, depth_bins=depth_bins, supersample=supersample)
+    impact.update(flood_attributes(flood_map, attributes))
+
+    records = stage_records[:]
+    stage_records.clear()
+
+    return name, impact, records
+
+
+# Compute the impact metrics of many flood maps over a pool of worker processes.
+# flood_sources is a dictionary of flood map name: file path or (geodatabase, layer) tuple.
+# workers is the number of processes (None uses every core). workers=1 runs batch_impact in this process instead.
+# attributes are flood map columns whose largest value is added to the output (e.g. ['Depth', 'rango']).
+# osm_cache=True loads the OpenStreetMap points from the cache of cache_osm (built once before the workers start).
+# tile_cache=True keeps preprocessed exposure tiles in the memory of each worker and a directory also saves them
+# there for every worker and later runs (see read_exposure_tiles).
+# memmap_store=True or a directory has every worker slice the same memory-mapped exposure stores of the rasters
+# (made once before the workers start, see exposure_store) instead of decoding the rasters.
+# crop_runs=True or a directory has every worker keep the cropland runs of the whole croplands raster in memory
+# (made once before the workers start, see read_crop_runs) instead of reading the croplands for each flood map.
+# depth_column and depth_bins break the metrics out by depth and supersample weights the cells by the fraction
+# of them that is flooded (see event_impact).
+# Returns a DataFrame indexed by flood map name in the same order as flood_sources
+# Note: scripts using this must call it under if __name__ == '__main__': so worker processes can import them
+def parallel_impact(flood_sources, croplands_path, pop_path, osm_file, workers=None, attributes=(), crop_value=2,
+                    osm_cache=False, tile_cache=False, memmap_store=False, depth_column=None, depth_bins=depth_bins,
+                    supersample=None, crop_runs=False):
+    import pandas as pd
+
+    if workers == 1:
+        flood_maps = {}
+        for name, source in flood_sources.items():
+            profiling['flood_map'] = name
+            flood_maps[name] = read_flood_map(source)
+
+        impact = batch_impact(flood_maps, croplands_path, pop_path, osm_file, crop_value=crop_value,
+                              osm_cache=osm_cache, tile_cache=tile_cache, memmap_store=memmap_store,
+                              depth_column=depth_column, depth_bins=depth_bins, supersample=supersample,
+                              crop_runs=crop_runs)
+        attrs = pd.DataFrame({name: flood_attributes(flood_map, attributes)
+                              for name, flood_map in flood_maps.items()}).T
+
+        return impact.join(attrs)
+
+    # Build or check the cache before the workers start so they do not all build it at once
+    if osm_cache:
+        cache_osm(osm_file)
+    if isinstance(tile_cache, str):
+        exposure_tile_dir(croplands_path, 'crop', crop_value, tile_cache)
+        exposure_tile_dir(pop_path, 'pop', crop_value, tile_cache)
+    if memmap_store:
+        store_dir = memmap_store if isinstance(memmap_store, str) else None
+        exposure_store(croplands_path, store_dir)
+        exposure_store(pop_path, store_dir)
+    if crop_runs:
+        build_crop_runs(croplands_path, crop_runs_file(croplands_path, crop_value, crop_runs), crop_value)
+
+    initializer = partial(init_worker, croplands_path, pop_path, osm_file, osm_cache=osm_cache, tile_cache=tile_cache,
+                          memmap_store=memmap_store, profile=profiling['enabled'], crop_runs=crop_runs)
+    with ProcessPoolExecutor(max_workers=workers, initializer=initializer) as executor:
+        futures = [executor.submit(worker_impact, name, source, attributes, crop_value, depth_column=depth_column,
+                                   depth_bins=depth_bins, supersample=supersample)
+                   for name, source in flood_sources.items()]
+
+        results = {}
+        for future in futures:
+            name, impact, records = future.result()
+            results[name] = impact
+            stage_records.extend(records)
+
+    with profile_stage('aggregate'):
+        return pd.DataFrame.from_dict(results, orient='index').reindex(list(flood_sources))
+
+
+# Compute the impact metrics of one flood map from another program without running a script.
+# flood_map is a GeoDataFrame in any CRS, a file path or a (geodatabase, layer) tuple.
+# The other arguments are the same as batch_impact.
+# Returns a dictionary of impact metric: value (e.g. {'Agriculture (ha)': 12.5, 'Population': 340.2, ...})
+def flood_map_impact(flood_map, croplands_path, pop_path, osm_file, crop_value=2, osm_cache=False, tile_cache=False,
+                     memmap_store=False, depth_column=None, depth_bins=depth_bins, supersample=None, crop_runs=False):
+    import geopandas as gpd
+
+    if not isinstance(flood_map, gpd.GeoDataFrame):
+        flood_map = read_flood_map(flood_map)
+
+    impact = batch_impact({'flood map': flood_map}, croplands_path, pop_path, osm_file, crop_value=crop_value,
+                          osm_cache=osm_cache, tile_cache=tile_cache, memmap_store=memmap_store,
+                          depth_column=depth_column, depth_bins=depth_bins, supersample=supersample,
+                          crop_runs=crop_runs)
+
+    return impact.iloc[0].to_dict()
+
+
+#######################
+#    Input Caching    #
+#######################
+
+# Files that go with a shapefile. The attributes (e.g. the OpenStreetMap 'other_tags') are in the .dbf and not the .shp
+shapefile_sidecars = ('.shx', '.dbf', '.prj', '.cpg')
+
+
+# Every file of a dataset: the files of a directory (e.g. a geodatabase) in name order,
+# a shapefile with the sidecar files it has, or else only the file itself
+def dataset_files(path):
+    if os.path.isdir(path):
+        return sorted(os.path.join(root, name) for root, dirs, names in os.walk(path) for name in names)
+
+    stem, ext = os.path.splitext(path)
+    if ext.lower() != '.shp':
+        return [path]
+
+    sidecars = [stem + (sidecar.upper() if ext.isupper() else sidecar) for sidecar in shapefile_sidecars]
+
+    return [path] + [sidecar for sidecar in sidecars if os.path.exists(sidecar)]
+
+
+# sha256 hash of a file. For a directory (e.g. a geodatabase) every file in it is hashed in name order
+# and a shapefile is hashed with its sidecar files (see dataset_files)
+def file_hash(path):
+    sha = hashlib.sha256()
+
+    for filename in dataset_files(path):
+        sha.update(os.path.relpath(filename, path).encode())
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha.update(chunk)
+
+    return sha.hexdigest()
+
+
+# Fingerprint of a file or directory to know when it has changed. A shapefile also changes with its sidecar files.
+# Returns a dictionary with the latest modification time and the total size of the files of the dataset
+# (see dataset_files) and (with hash_file=True) their sha256 hash
+def file_fingerprint(path, hash_file=True):
+    stats = [os.stat(filename) for filename in dataset_files(path)]
+    fingerprint = {'mtime': max([st.st_mtime for st in stats], default=os.stat(path).st_mtime),
+                   'size': sum(st.st_size for st in stats)}
+
+    if hash_file:
+        fingerprint['hash'] = file_hash(path)
+
+    return fingerprint
+
+
+# Check if a file still matches a fingerprint from file_fingerprint.
+# The file is only hashed when its modification time changed but not its size
+def same_file(fingerprint, path):
+    if fingerprint is None or not os.path.exists(path):
+        return False
+
+    current = file_fingerprint(path, hash_file=False)
+    if current['size'] != fingerprint['size']:
+        return False
+    if current['mtime'] == fingerprint['mtime']:
+        return True
+
+    return 'hash' in fingerprint and file_hash(path) == fingerprint['hash']
+
+
+# Check if a file still matches a fingerprint with same_file. Returns the fingerprint with the current modification
+# time of the file when it does (so a file that was only touched is not hashed again next time) and None otherwise
+def refresh_fingerprint(fingerprint, path):
+    if not same_file(fingerprint, path):
+        return None
+
+    return dict(fingerprint, **file_fingerprint(path, hash_file=False))
+
+
+# Fingerprints of the files of many entries (name: path) as name: fingerprint. old is a dictionary of name: fingerprint
+# from an earlier run. Entries whose file still matches the old fingerprint keep it with the current modification
+# time (see refresh_fingerprint) and the others are fingerprinted again. Each file is only checked or fingerprinted
+# once, so entries of the same file (the layers of a geodatabase) share one fingerprint.
+# An entry changed when the 'hash' of its fingerprint is not the same as the old one
+def refresh_fingerprints(paths, old=None):
+    old = old or {}
+    refreshed = {}
+    current = {}
+
+    fingerprints = {}
+    for name, path in paths.items():
+        previous = old.get(name)
+
+        if previous is not None:
+            check = (path, json.dumps(previous, sort_keys=True))
+            if check not in refreshed:
+                refreshed[check] = refresh_fingerprint(previous, path)
+            if refreshed[check] is not None:
+                fingerprints[name] = refreshed[check]
+                continue
+
+        if path not in current:
+            current[path] = file_fingerprint(path)
+        fingerprints[name] = current[path]
+
+    return fingerprints
+
+
+# Parse the 'other_tags' of an OpenStreetMap point shapefile into columns once and save them with the points
+# to a GeoParquet file (cache_file defaults to the OSM file name ending in '_tags.parquet').
+# keys are the other_tags keys saved as columns. The amenity is always saved as 'Amenity' with its 'Amenity_Group'
+# and only the points with at least one of the keys are kept. 'lon' and 'lat' columns are saved for bbox reads.
+# The cache is rebuilt when the OSM shapefile or any of its sidecar files (by modification time and hash, see
+# file_fingerprint) or the keys change.
+# Returns the path of the cache file
+def cache_osm(osm_file, cache_file=None, keys=('amenity',)):
+    import pandas as pd
+    import geopandas as gpd
+
+    if cache_file is None:
+        cache_file = os.path.splitext(osm_file)[0] + '_tags.parquet'
+    meta_file = cache_file + '.json'
+    keys = ['amenity'] + [key for key in keys if key != 'amenity']
+
+    # Use the cache if it was made from the same OSM file with the same keys
+    if os.path.exists(cache_file) and os.path.exists(meta_file):
+        with open(meta_file) as f:
+            meta = json.load(f)
+        source = refresh_fingerprint(meta['source'], osm_file)
+        if meta['keys'] == keys and source is not None:
+            if source != meta['source']:
+                with open(meta_file, 'w') as f:
+                    json.dump(dict(meta, source=source), f)
+            return cache_file
+
+    osm_pts = gpd.read_file(osm_file)
+
+    # Use a regular expression to extract each key from the column named 'other_tags'
+    tags = pd.DataFrame({key: osm_pts['other_tags'].str.extract('"%s"=>"(.+?)"' % re.escape(key), expand=False)
+                         for key in keys})
+    keep = tags.notna().any(axis=1).to_numpy()
+    tags = tags[keep].rename(columns={'amenity': 'Amenity'})
+
+    osm_tags = gpd.GeoDataFrame(tags, geometry=osm_pts.geometry[keep], crs=osm_pts.crs)
+    osm_tags.insert(1, 'Amenity_Group', classify_amenities(osm_tags['Amenity']))
+
+    # Coordinates in EPSG:4326 so later runs can only load the points within their flood maps
+    lonlat = osm_tags.geometry.to_crs(epsg=4326) if osm_tags.crs != "EPSG:4326" else osm_tags.geometry
+    osm_tags['lon'] = lonlat.x
+    osm_tags['lat'] = lonlat.y
+
+    osm_tags.reset_index(drop=True).to_parquet(cache_file)
+
+    with open(meta_file, 'w') as f:
+        json.dump({'source': file_fingerprint(osm_file), 'keys': keys}, f)
+
+    return cache_file
+
+
+# Load the amenity points of a cache from cache_osm in the same form as prepare_osm.
+# bbox (minx, miny, maxx, maxy in EPSG:4326) only loads the points within it and
+# columns are any other cached keys to load as well
+def read_osm_cache(cache_file, bbox=None, columns=()):
+    import geopandas as gpd
+
+    filters = [('Amenity', '!=', '')]
+    if bbox is not None:
+        filters += [('lon', '>=', bbox[0]), ('lat', '>=', bbox[1]), ('lon', '<=', bbox[2]), ('lat', '<=', bbox[3])]
+
+    osm_pts = gpd.read_parquet(cache_file, columns=['Amenity', 'Amenity_Group', 'geometry'] + list(columns),
+                               filters=filters)
+
+    return osm_pts.reset_index(drop=True)
+
+
+#######################
+#  Flood Map Catalog  #
+#######################
+
+# Describe one flood map (a file or a geodatabase layer) without keeping its geometries:
+# bounds, crs (as WKT), feature count, schema and the min and max of every numeric attribute
+def describe_flood_map(path, layer=None):
+    import pandas as pd
+    import pyogrio.raw
+    import shapely
+    from pyproj import CRS
+
+    # The flood map is read once: the bounds come from its geometries and the min and max from its attributes
+    meta, _, geometry, field_data = pyogrio.raw.read(path, layer=layer)
+    entry = {'bounds': [float(value) for value in shapely.total_bounds(shapely.from_wkb(geometry))],
+             'crs': CRS.from_user_input(meta['crs']).to_wkt() if meta['crs'] else None, 'count': len(geometry),
+             'schema': {'geometry': meta['geometry_type'], 'properties': dict(zip(meta['fields'], meta['dtypes']))}}
+
+    attributes = pd.DataFrame(dict(zip(meta['fields'], field_data))).select_dtypes('number')
+    entry['min'] = {column: float(value) for column, value in attributes.min().items() if pd.notna(value)}
+    entry['max'] = {column: float(value) for column, value in attributes.max().items() if pd.notna(value)}
+
+    return entry
+
+
+# Scan a directory of flood map files (pattern such as '*.geojson') or a geodatabase (.gdb) once and record
+# the description of every flood map (see describe_flood_map) with the fingerprint of its file in a JSON index.
+# The index is saved to index_file (flood_map_index.json in the directory or <name>.gdb_index.json by default)
+# and a flood map is only read again when its file changed. For a geodatabase, exclude is a list of layers to skip
+# and only polygon layers are kept, so catchments, drainage lines and tables can be left out without hardcoding them.
+# Returns a dictionary of flood map name (file path or layer name): description with its 'source'
+def catalog_flood_maps(source, index_file=None, pattern='*.geojson', exclude=()):
+    import fiona
+
+    is_gdb = source.rstrip('/\\').lower().endswith('.gdb')
+    if index_file is None:
+        index_file = source.rstrip('/\\') + '_index.json' if is_gdb else os.path.join(source, 'flood_map_index.json')
+
+    index = {}
+    if os.path.exists(index_file):
+        with open(index_file) as f:
+            index = json.load(f)
+
+    if is_gdb:
+        entries = {layer: [source, layer] for layer in fiona.listlayers(source) if layer not in exclude}
+    else:
+        entries = {path: path for path in sorted(glob.glob(os.path.join(source, pattern)))}
+
+    # Every layer of a geodatabase shares the fingerprint of the geodatabase so each file is only checked once
+    paths = {name: entry_source[0] if is_gdb else entry_source for name, entry_source in entries.items()}
+    fingerprints = refresh_fingerprints(paths, {name: entry['fingerprint'] for name, entry in index.items()})
+
+    catalog = {}
+    for name, entry_source in entries.items():
+        old = index.get(name)
+
+        # Reuse the description of flood maps whose file did not change
+        if old is not None and old['fingerprint'].get('hash') == fingerprints[name]['hash']:
+            catalog[name] = dict(old, fingerprint=fingerprints[name])
+            continue
+
+        entry = describe_flood_map(*entry_source) if is_gdb else describe_flood_map(paths[name])
+        entry['source'] = entry_source
+        entry['fingerprint'] = fingerprints[name]
+        catalog[name] = entry
+
+    # Layers that are not flood maps stay in the index so they are not read again next time
+    with open(index_file, 'w') as f:
+        json.dump(catalog, f)
+
+    # Older indexes use the fiona names of the 3D geometry types
+    polygon_types = ('Polygon', 'MultiPolygon', 'Polygon Z', 'MultiPolygon Z', '3D Polygon', '3D MultiPolygon')
+    if is_gdb:
+        catalog = {name: entry for name, entry in catalog.items()
+                   if entry['schema']['geometry'] in polygon_types}
+
+    return catalog
+
+
+# Flood map sources of a catalog from catalog_flood_maps for parallel_impact
+# (file paths or (geodatabase, layer) tuples)
+def catalog_sources(catalog):
+    return {name: tuple(entry['source']) if isinstance(entry['source'], list) else entry['source']
+            for name, entry in catalog.items()}
+
+
+# Largest value of an attribute of every flood map of a catalog (nan if a flood map does not have it)
+def catalog_max(catalog, column):
+    return {name: entry['max'].get(column, np.nan) for name, entry in catalog.items()}
+
+
+#######################
+#  Incremental Runs   #
+#######################
+
+# Fingerprints of flood map sources (file paths or (geodatabase, layer) tuples) as name: fingerprint.
+# old is a dictionary of name: fingerprint from an earlier run (see refresh_fingerprints)
+def source_fingerprints(flood_sources, old=None):
+    return refresh_fingerprints({name: source[0] if isinstance(source, tuple) else source
+                                 for name, source in flood_sources.items()}, old)
+
+
+# Compute the impact metrics of only the flood maps that are new or changed since the last run and merge them with
+# the metrics of the other flood maps kept in state_file (a JSON file, e.g. next to the impact CSV).
+# state_file keeps the fingerprint of every flood map and exposure dataset with the metrics of each flood map.
+# Every flood map is computed again when the croplands, population or OpenStreetMap file, crop_value, the depth
+# bins or supersample changed.
+# Flood maps that are no longer in flood_sources are dropped, unless keep_others=True keeps them in state_file for
+# later runs (e.g. when only some of the flood maps sharing state_file are run). The other arguments are the same as
+# parallel_impact. Returns the same DataFrame as parallel_impact
+def incremental_impact(flood_sources, croplands_path, pop_path, osm_file, state_file, workers=None, crop_value=2,
+                       osm_cache=False, tile_cache=False, memmap_store=False, depth_column=None, depth_bins=depth_bins,
+                       supersample=None, crop_runs=False, keep_others=False):
+    import pandas as pd
+
+    state = {}
+    if os.path.exists(state_file):
+        with open(state_file) as f:
+            state = json.load(f)
+
+    # Exposure datasets that did not change keep their hash (see refresh_fingerprint)
+    options = {'crop_value': crop_value, 'depth_column': depth_column, 'depth_bins': list(depth_bins),
+               'supersample': supersample}
+    old_exposure = state.get('exposure', {})
+    same_exposure = options == state.get('options')
+    exposure = {}
+    for path in (croplands_path, pop_path, osm_file):
+        key = os.path.abspath(path)
+        exposure[key] = refresh_fingerprint(old_exposure.get(key), path)
+        if exposure[key] is None:
+            exposure[key] = file_fingerprint(path)
+            same_exposure = False
+
+    old_maps = state.get('flood_maps', {}) if same_exposure else {}
+
+    fingerprints = source_fingerprints(flood_sources, {name: entry['fingerprint'] for name, entry in old_maps.items()})
+    changed = {name: source for name, source in flood_sources.items()
+               if name not in old_maps or old_maps[name]['fingerprint'].get('hash') != fingerprints[name]['hash']}
+
+    impacts = {name: entry['impact'] for name, entry in old_maps.items()}
+    if changed:
+        metrics = parallel_impact(changed, croplands_path, pop_path, osm_file, workers, crop_value=crop_value,
+                                  osm_cache=osm_cache, tile_cache=tile_cache, memmap_store=memmap_store,
+                                  depth_column=depth_column, depth_bins=depth_bins, supersample=supersample,
+                                  crop_runs=crop_runs)
+        impacts.update(metrics.to_dict('index'))
+
+    flood_maps = {name: entry for name, entry in old_maps.items() if keep_others and name not in flood_sources}
+    flood_maps.update({name: {'fingerprint': fingerprints[name], 'impact': impacts[name]} for name in flood_sources})
+
+    state = {'exposure': exposure, 'options': options, 'flood_maps': flood_maps}
+    with open(state_file, 'w') as f:
+        json.dump(state, f)
+
+    return pd.DataFrame.from_dict({name: impacts[name] for name in flood_sources}, orient='index')
+
+
+#######################
+# Exposure Tile Cache #
+#######################
+
+# Preprocessed exposure tiles kept in memory by exposure_tile:
+# (raster path, modification time, size, kind, crop_value, tile row, tile column) -> array.
+# The least recently used tile is the first one
+exposure_tiles = {}
+
+# Largest number of bytes of exposure tiles kept in memory. The least recently used tiles are dropped first
+exposure_tile_bytes = 512 * 2 ** 20
+
+# Largest number of bytes of exposure tiles saved in a tile cache directory for every raster.
+# The least recently used tiles are deleted first (see evict_exposure_tiles)
+exposure_tile_disk_bytes = 4 * 2 ** 30
+
+# Number of rows and columns of raster cells in each exposure tile
+exposure_tile_size = 512
+
+
+# Preprocess part of an exposure raster read with masked=True.
+# kind='crop' keeps crop_value for the cells equal to crop_value and 0 for every other cell (including noData)
+# and kind='pop' keeps the population with 0 for noData and nan cells, so neither needs a mask anymore
+def preprocess_exposure(array, kind, crop_value=2):
+    invalid = np.ma.getmaskarray(array)
+
+    if kind == 'crop':
+        return np.where((array.data == crop_value) & ~invalid, crop_value, 0).astype(array.dtype)
+
+    return np.where(invalid | ~np.isfinite(array.data), 0, array.data).astype(array.dtype)
+
+
+# Directory of the tiles of one preprocessed exposure raster in cache_dir.
+# The tiles are deleted when the raster file changed since they were made
+def exposure_tile_dir(input_rasterfile, kind, crop_value, cache_dir):
+    key = (os.path.abspath(input_rasterfile), kind, crop_value if kind == 'crop' else None, exposure_tile_size)
+    tile_dir = os.path.join(cache_dir, hashlib.sha256(repr(key).encode()).hexdigest()[:16])
+    meta_file = os.path.join(tile_dir, 'source.json')
+
+    if os.path.exists(meta_file):
+        with open(meta_file) as f:
+            fingerprint = json.load(f)
+
+        current = refresh_fingerprint(fingerprint, input_rasterfile)
+        if current is not None:
+            if current != fingerprint:
+                with open(meta_file, 'w') as f:
+                    json.dump(current, f)
+            return tile_dir
+
+    # Start again from an empty directory
+    shutil.rmtree(tile_dir, ignore_errors=True)
+    os.makedirs(tile_dir, exist_ok=True)
+    with open(meta_file, 'w') as f:
+        json.dump(file_fingerprint(input_rasterfile), f)
+
+    return tile_dir
+
+
+# Delete the least recently used tiles of every raster in cache_dir until they take at most max_bytes
+# (exposure_tile_disk_bytes by default). Loading a tile from the directory touches its file,
+# so the tiles with the oldest modification time are the least recently used ones
+def evict_exposure_tiles(cache_dir, max_bytes=None):
+    max_bytes = exposure_tile_disk_bytes if max_bytes is None else max_bytes
+
+    tiles = []
+    for tile_file in glob.glob(os.path.join(cache_dir, '*', '*.npy')):
+        # Skip the temporary files of tiles being saved
+        if not re.fullmatch(r'\d+_\d+\.npy', os.path.basename(tile_file)):
+            continue
+        try:
+            st = os.stat(tile_file)
+        except FileNotFoundError:
+            # Deleted by another process
+            continue
+        tiles.append((st.st_mtime, st.st_size, tile_file))
+
+    total = sum(size for _, size, _ in tiles)
+    for _, size, tile_file in sorted(tiles):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(tile_file)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+# One preprocessed tile of an open exposure raster from memory, from tile_dir or else read from the raster.
+# source identifies the raster and its preprocessing (see read_exposure_tiles).
+# Returns the tile and whether it was saved to tile_dir
+def exposure_tile(src, source, tile_dir, row, col, kind, crop_value):
+    from rasterio.windows import Window
+
+    key = source + (row, col)
+    tile = exposure_tiles.pop(key, None)
+    saved = False
+
+    if tile is None:
+        tile_file = os.path.join(tile_dir, '%d_%d.npy' % (row, col)) if tile_dir is not None else None
+
+        if tile_file is not None:
+            try:
+                tile = np.load(tile_file)
+                # The tile becomes the most recently used one in tile_dir as well
+                os.utime(tile_file)
+            except FileNotFoundError:
+                # Not saved yet or deleted by evict_exposure_tiles
+                pass
+
+        if tile is None:
+            size = exposure_tile_size
+            window = Window(col * size, row * size, min(size, src.width - col * size),
+                            min(size, src.height - row * size))
+            tile = preprocess_exposure(src.read(1, window=window, masked=True), kind, crop_value)
+
+            if tile_file is not None:
+                # Save to a temporary file first so other processes never load part of a tile
+                temp_file = '%s.%d.npy' % (tile_file[:-4], os.getpid())
+                np.save(temp_file, tile)
+                os.replace(temp_file, tile_file)
+                saved = True
+
+    # The tile becomes the most recently used one and the least recently used tiles are dropped
+    exposure_tiles[key] = tile
+    total = sum(cached.nbytes for cached in exposure_tiles.values())
+    while total > exposure_tile_bytes and len(exposure_tiles) > 1:
+        total -= exposure_tiles.pop(next(iter(exposure_tiles))).nbytes
+
+    return tile, saved
+
+
+# Read the first band of an exposure raster for the union of the extents of flood maps through a cache of tiles
+# aligned to the raster grid (exposure_tile_size cells) that are already preprocessed by preprocess_exposure,
+# so events over the same region reuse the tiles instead of reading and preprocessing the raster again.
+# kind is 'crop' (crop_value / 0 cropland mask) or 'pop' (population with 0 for noData).
+# The tiles are kept in memory and, with cache_dir, saved there so later runs and other worker processes reuse them
+# (at most exposure_tile_disk_bytes of them, see evict_exposure_tiles).
+# Returns an exposure grid like read_exposure, without masked cells
+def read_exposure_tiles(input_rasterfile, flood_maps, kind, crop_value=2, cache_dir=None):
+    import rasterio as rio
+    from rasterio.windows import Window, union
+
+    st = os.stat(input_rasterfile)
+    source = (os.path.abspath(input_rasterfile), st.st_mtime, st.st_size, kind, crop_value if kind == 'crop' else None)
+    tile_dir = exposure_tile_dir(input_rasterfile, kind, crop_value, cache_dir) if cache_dir is not None else None
+    size = exposure_tile_size
+
+    with rio.open(input_rasterfile) as src:
+        windows = [flood_window(src, flood_map) for flood_map in flood_maps]
+        windows = [w for w in windows if w.width > 0 and w.height > 0]
+        window = union(*windows) if windows else Window(0, 0, 0, 0)
+
+        row_off, col_off = int(window.row_off), int(window.col_off)
+        height, width = int(window.height), int(window.width)
+        array = np.zeros((height, width), dtype=src.dtypes[0])
+
+        # Copy the part of every tile that overlaps the window
+        saved = False
+        for row in range(row_off // size, math.ceil((row_off + height) / size)):
+            for col in range(col_off // size, math.ceil((col_off + width) / size)):
+                tile, tile_saved = exposure_tile(src, source, tile_dir, row, col, kind, crop_value)
+                saved = saved or tile_saved
+
+                row_start, row_stop = max(row * size, row_off), min((row + 1) * size, row_off + height)
+                col_start, col_stop = max(col * size, col_off), min((col + 1) * size, col_off + width)
+                array[row_start - row_off:row_stop - row_off, col_start - col_off:col_stop - col_off] = \
+                    tile[row_start - row * size:row_stop - row * size, col_start - col * size:col_stop - col * size]
+
+        # Keep the tile cache directory within exposure_tile_disk_bytes once new tiles are saved
+        if saved:
+            evict_exposure_tiles(cache_dir)
+
+        return {'array': np.ma.masked_array(array), 'transform': src.window_transform(window), 'crs': src.crs}
+
+
+# Read an exposure raster for flood maps with read_exposure, or through the tile cache of read_exposure_tiles
+# when tile_cache is True (tiles kept in memory) or a directory (tiles kept in memory and saved in the directory).
+# memmap_store=True (store next to the raster) or a directory slices the memory-mapped exposure store of the raster
+# instead (see exposure_store), which is made the first time.
+# For croplands, crop_runs=True (runs next to the raster) or a directory loads the cropland runs of the whole raster
+# instead (see read_crop_runs), which are made the first time and replace tile_cache and memmap_store
+def load_exposure(input_rasterfile, flood_maps, kind, crop_value=2, tile_cache=False, memmap_store=False,
+                  crop_runs=False):
+    with profile_stage('read croplands' if kind == 'crop' else 'read population'):
+        if kind == 'crop' and crop_runs:
+            return read_crop_runs(input_rasterfile, crop_value, crop_runs)
+
+        if memmap_store:
+            store_dir = memmap_store if isinstance(memmap_store, str) else None
+            return read_exposure_store(exposure_store(input_rasterfile, store_dir), flood_maps)
+
+        if not tile_cache:
+            return read_exposure(input_rasterfile, flood_maps)
+
+        return read_exposure_tiles(input_rasterfile, flood_maps, kind, crop_value=crop_value,
+                                   cache_dir=tile_cache if isinstance(tile_cache, str) else None)
+
+
+#######################
+#   Exposure Store    #
+#######################
+
+# Exposure stores opened by exposure_store: store file -> (modification time of the store file, exposure store)
+exposure_stores = {}
+
+
+# Name of a file made from a raster in a shared directory: the raster file name followed by the hash of its absolute
+# path and suffix, so rasters with the same file name in different directories (e.g. DR/croplands.tif and
+# PE/croplands.tif) do not overwrite each other
+def raster_file_name(input_rasterfile, suffix):
+    stem = os.path.splitext(os.path.basename(input_rasterfile))[0]
+    digest = hashlib.sha256(os.path.abspath(input_rasterfile).encode()).hexdigest()[:12]
+
+    return '%s_%s%s' % (stem, digest, suffix)
+
+
+# Grid (transform, crs, shape and noData) of an open raster and the fingerprint of the raster file.
+# They are saved in a '.json' file next to each file made from the raster (see publish_raster_file)
+def raster_file_meta(src, input_rasterfile):
+    return {'transform': list(src.transform)[:6], 'crs': src.crs.to_wkt() if src.crs else None,
+            'shape': [src.height, src.width], 'nodata': src.nodata, 'source': file_fingerprint(input_rasterfile)}
+
+
+# Check if a file made from a raster is up to date: it exists and the metadata saved next to it has the same settings
+# (e.g. crop_value) and a fingerprint that the raster still matches. The fingerprint is saved with the current
+# modification time of the raster when the raster was only touched (see refresh_fingerprint)
+def raster_file_current(derived_file, input_rasterfile, **settings):
+    meta_file = derived_file + '.json'
+    if not os.path.exists(derived_file) or not os.path.exists(meta_file):
+        return False
+
+    with open(meta_file) as f:
+        meta = json.load(f)
+
+    source = refresh_fingerprint(meta['source'], input_rasterfile)
+    if source is None or any(meta.get(setting) != value for setting, value in settings.items()):
+        return False
+
+    if source != meta['source']:
+        with open(meta_file, 'w') as f:
+            json.dump(dict(meta, source=source), f)
+
+    return True
+
+
+# Windows of full rows of an open raster, a strip of its native blocks at a time (at least block_rows rows),
+# so the memory used to read the whole raster does not depend on the raster size
+def raster_strips(src, block_rows=1024):
+    from rasterio.windows import Window
+
+    strip_rows = max(block_rows // src.block_shapes[0][0], 1) * src.block_shapes[0][0]
+
+    for row in range(0, src.height, strip_rows):
+        yield Window(0, row, src.width, min(strip_rows, src.height - row))
+
+
+# Temporary file of this process that a file made from a raster is written to before publish_raster_file
+def temp_raster_file(derived_file):
+    return '%s.%d.tmp' % (derived_file, os.getpid())
+
+
+# Move a file made from a raster from its temporary file into place and save its metadata next to it.
+# Other processes never open part of the file since it only appears once it is complete
+def publish_raster_file(temp_file, derived_file, meta):
+    os.replace(temp_file, derived_file)
+    with open(derived_file + '.json', 'w') as f:
+        json.dump(meta, f)
+
+
+# Open a file made from a raster with opener once per process. opened keeps file -> (modification time, opened file)
+# and the file is opened again when it was made again
+def open_raster_file(opened, derived_file, opener):
+    mtime = os.stat(derived_file).st_mtime
+    cached = opened.get(derived_file)
+    if cached is None or cached[0] != mtime:
+        cached = opened[derived_file] = (mtime, opener(derived_file))
+
+    return cached[1]
+
+
+# Convert the first band of an exposure raster once into an uncompressed .npy array on local disk
+# (store_file defaults to the raster file name ending in '.npy') so it can be opened with numpy.memmap.
+# The raster is copied a strip at a time (see raster_strips). The grid, noData and fingerprint of the raster are saved
+# in store_file + '.json' and the store is only made again when the raster changes. Returns the path of the store file
+def build_exposure_store(input_rasterfile, store_file=None, block_rows=1024):
+    import rasterio as rio
+
+    if store_file is None:
+        store_file = os.path.splitext(input_rasterfile)[0] + '.npy'
+
+    if raster_file_current(store_file, input_rasterfile):
+        return store_file
+
+    temp_file = temp_raster_file(store_file)
+    with rio.open(input_rasterfile) as src:
+        meta = raster_file_meta(src, input_rasterfile)
+
+        array = np.lib.format.open_memmap(temp_file, mode='w+', dtype=src.dtypes[0], shape=(src.height, src.width))
+        for window in raster_strips(src, block_rows):
+            array[window.row_off:window.row_off + window.height] = src.read(1, window=window)
+
+        array.flush()
+        del array
+
+    publish_raster_file(temp_file, store_file, meta)
+
+    return store_file
+
+
+# Open an exposure store from build_exposure_store. The array is memory-mapped so nothing is read until it is sliced.
+# Returns a dictionary with the memory-mapped 'array' and its 'transform', 'crs' and 'nodata'
+def open_exposure_store(store_file):
+    from rasterio.transform import Affine
+    from rasterio.crs import CRS
+
+    with open(store_file + '.json') as f:
+        meta = json.load(f)
+
+    return {'array': np.load(store_file, mmap_mode='r'), 'transform': Affine(*meta['transform']),
+            'crs': CRS.from_wkt(meta['crs']) if meta['crs'] else None, 'nodata': meta['nodata']}
+
+
+# Open the exposure store of a raster, making it first with build_exposure_store when needed.
+# store_dir is the directory of the store file (next to the raster when None, see raster_file_name).
+# Each store is opened once per process and opened again when it was made again
+def exposure_store(input_rasterfile, store_dir=None):
+    store_file = None
+    if store_dir is not None:
+        os.makedirs(store_dir, exist_ok=True)
+        store_file = os.path.join(store_dir, raster_file_name(input_rasterfile, '.npy'))
+
+    return open_raster_file(exposure_stores, build_exposure_store(input_rasterfile, store_file), open_exposure_store)
+
+
+# Gather the pixel window of an exposure store that covers the extent of the flood map
+def store_window(store, flood_map):
+    from rasterio.warp import transform_bounds
+
+    bounds = transform_bounds(flood_map.crs, store['crs'], *flood_map.total_bounds)
+
+    return bounds_window(bounds, store['transform'], store['array'].shape[1], store['array'].shape[0])
+
+
+# Slice an exposure store for the union of the extents of one or more flood maps.
+# The slice is a view of the memory-mapped array so only the pages of the window are read from disk.
+# Returns an exposure grid like read_exposure (noData is masked)
+def read_exposure_store(store, flood_maps):
+    from rasterio.windows import Window, union
+    from rasterio.windows import transform as window_transform
+
+    windows = [store_window(store, flood_map) for flood_map in flood_maps]
+    windows = [w for w in windows if w.width > 0 and w.height > 0]
+    window = union(*windows) if windows else Window(0, 0, 0, 0)
+
+    rows, cols = window.toslices()
+    array = store['array'][rows, cols]
+
+    nodata = store['nodata']
+    if nodata is None:
+        mask = np.ma.nomask
+    elif np.isnan(nodata):
+        mask = np.isnan(array)
+    else:
+        mask = array == nodata
+
+    return {'array': np.ma.masked_array(array, mask=mask), 'transform': window_transform(window, store['transform']),
+            'crs': store['crs']}
+
+
+#######################
+#    Cropland Runs    #
+#######################
+
+# Cropland runs opened by crop_runs: runs file -> (modification time of the runs file, croplands grid)
+cropland_runs = {}
+
+
+# Convert the cells equal to crop_value of a croplands raster once into runs of consecutive cropland cells in each row
+# (runs_file defaults to the raster file name ending in '_crop<crop_value>_runs.npz').
+# Cultivated cropland is usually a small part of the cells, so the runs of a whole country fit in memory where
+# the dense grid would not. The runs are kept like a sparse matrix: 'starts' and 'stops' are the first and past the
+# last column of every run in row order and the runs of row r are starts[row_ptr[r]:row_ptr[r + 1]].
+# The raster is read a strip at a time (see raster_strips). The grid, crop_value and fingerprint of the raster are
+# saved in runs_file + '.json' and the runs are only made again when the raster changes.
+# Returns the path of the runs file
+def build_crop_runs(input_rasterfile, runs_file=None, crop_value=2, block_rows=1024):
+    import rasterio as rio
+
+    if runs_file is None:
+        runs_file = crop_runs_file(input_rasterfile, crop_value)
+
+    if raster_file_current(runs_file, input_rasterfile, crop_value=crop_value):
+        return runs_file
+
+    counts, starts, stops = [], [], []
+    with rio.open(input_rasterfile) as src:
+        meta = dict(raster_file_meta(src, input_rasterfile), crop_value=crop_value)
+
+        for window in raster_strips(src, block_rows):
+            strip = src.read(1, window=window, masked=True)
+            is_crop = (strip.data == crop_value) & ~np.ma.getmaskarray(strip)
+
+            # A run starts where a row goes from other cells to cropland and stops where it goes back
+            edges = np.diff(np.pad(is_crop, ((0, 0), (1, 1))).view(np.int8), axis=1)
+            start_rows, start_cols = np.nonzero(edges == 1)
+            counts.append(np.bincount(start_rows, minlength=window.height))
+            starts.append(start_cols.astype(np.int32))
+            stops.append(np.nonzero(edges == -1)[1].astype(np.int32))
+
+    row_ptr = np.concatenate([[0], np.cumsum(np.concatenate(counts)) if counts else []]).astype(np.int64)
+
+    temp_file = temp_raster_file(runs_file)
+    with open(temp_file, 'wb') as f:
+        np.savez(f, row_ptr=row_ptr, starts=np.concatenate(starts) if starts else np.zeros(0, np.int32),
+                 stops=np.concatenate(stops) if stops else np.zeros(0, np.int32))
+    publish_raster_file(temp_file, runs_file, meta)
+
+    return runs_file
+
+
+# Open the cropland runs from build_crop_runs. The runs are loaded into memory.
+# Returns a croplands grid: a dictionary with the 'runs' (row_ptr, starts and stops) and the 'shape', 'transform'
+# and 'crs' of the raster, which every croplands function takes like a grid from read_exposure
+def open_crop_runs(runs_file):
+    from rasterio.transform import Affine
+    from rasterio.crs import CRS
+
+    with open(runs_file + '.json') as f:
+        meta = json.load(f)
+
+    with np.load(runs_file) as runs:
+        runs = {name: runs[name] for name in ('row_ptr', 'starts', 'stops')}
+
+    return {'runs': runs, 'shape': tuple(meta['shape']), 'transform': Affine(*meta['transform']),
+            'crs': CRS.from_wkt(meta['crs']) if meta['crs'] else None}
+
+
+# Runs file of a croplands raster in runs_dir (see raster_file_name), or next to the raster when it is not a directory
+def crop_runs_file(input_rasterfile, crop_value=2, runs_dir=None):
+    suffix = '_crop%s_runs.npz' % crop_value
+    if not isinstance(runs_dir, str):
+        return os.path.splitext(input_rasterfile)[0] + suffix
+
+    os.makedirs(runs_dir, exist_ok=True)
+
+    return os.path.join(runs_dir, raster_file_name(input_rasterfile, suffix))
+
+
+# Croplands grid of the cropland runs of a raster, making them first with build_crop_runs when needed.
+# runs_dir is the directory of the runs file (next to the raster when it is None or True).
+# The runs of the whole raster are opened once per process and kept for every flood map
+def read_crop_runs(input_rasterfile, crop_value=2, runs_dir=None):
+    runs_file = build_crop_runs(input_rasterfile, crop_runs_file(input_rasterfile, crop_value, runs_dir), crop_value)
+
+    return open_raster_file(cropland_runs, runs_file, open_crop_runs)
+
+
+# The cropland runs within a pixel window of the grid, cut at the edges of the window.
+# Returns a dictionary with the 'rows', 'starts' and 'stops' of the runs relative to the window and its 'shape'
+def window_runs(runs, window):
+    row_off, col_off = window.row_off, window.col_off
+    height, width = window.height, window.width
+    row_ptr = runs['row_ptr'][row_off:row_off + height + 1]
+
+    rows = np.repeat(np.arange(height, dtype=np.int64), np.diff(row_ptr))
+    starts = np.clip(runs['starts'][row_ptr[0]:row_ptr[-1]], col_off, col_off + width) - col_off
+    stops = np.clip(runs['stops'][row_ptr[0]:row_ptr[-1]], col_off, col_off + width) - col_off
+
+    keep = stops > starts
+
+    return {'rows': rows[keep], 'starts': starts[keep], 'stops': stops[keep], 'shape': (height, width)}
+
+
+# Sum of values (a flood mask or fraction on the cells of the window) over the cropland runs of each row of a window.
+# Only the cells of the runs are added (numpy.add.reduceat over the run boundaries)
+def runs_rows(runs, values):
+    height, width = values.shape
+    if len(runs['starts']) == 0:
+        return np.zeros(height)
+
+    flat = values.ravel()
+    bounds = np.empty(2 * len(runs['starts']), dtype=np.int64)
+    bounds[0::2] = runs['rows'] * width + runs['starts']
+    bounds[1::2] = runs['rows'] * width + runs['stops']
+
+    # The last run can stop at the end of the array, which reduceat already sums up to
+    if bounds[-1] == flat.size:
+        bounds = bounds[:-1]
+
+    sums = np.add.reduceat(flat, bounds, dtype=np.float64)[0::2]
+
+    return np.bincount(runs['rows'], weights=sums, minlength=height)
+
+
+#######################
+#   Instrumentation   #
+#######################
+
+# Records of the stages of the impact pipeline made by profile_stage while profiling is on (see start_profiling)
+stage_records = []
+
+# Whether the stages are profiled, the name of the flood map being processed (None for stages shared by all)
+# and the largest RSS so far of each stage that is running, from the outermost to the innermost (see profile_stage)
+profiling = {'enabled': False, 'flood_map': None, 'peaks': []}
+
+# Memory column of the stage records. On Linux the high-water mark of the RSS of the process is reset when a stage
+# starts, so each stage records its own peak RSS. Other platforms record the RSS at the end of each stage instead
+rss_column = 'Peak RSS (MB)' if os.access('/proc/self/clear_refs', os.W_OK) else 'End RSS (MB)'
+
+
+# Bytes read and written by this process so far, including reads served from the page cache.
+# Uses /proc/self/io on Linux and psutil on other platforms if it is installed, else (nan, nan)
+def io_bytes():
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        pass
+
+    try:
+        import psutil
+        counters = psutil.Process().io_counters()
+        return counters.read_bytes, counters.write_bytes
+    except (ImportError, AttributeError):
+        return np.nan, np.nan
+
+
+# Current resident set size (RSS) of this process in bytes.
+# Uses /proc/self/statm on Linux and psutil on other platforms if it is installed, else nan
+def current_rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, IndexError, ValueError, AttributeError):
+        pass
+
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        return np.nan
+
+
+# Largest RSS of this process in bytes since the high-water mark was last reset (see reset_peak_rss).
+# Uses VmHWM of /proc/self/status on Linux, else nan
+def peak_rss():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+
+    return np.nan
+
+
+# Reset the high-water mark of the RSS of this process to its current RSS (Linux only)
+def reset_peak_rss():
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+
+
+# Record the wall time, CPU time, peak RSS (see rss_column), the change of the RSS since the start and bytes read and
+# written of a stage of the pipeline for the flood map being processed. Does nothing unless profiling is on
+@contextmanager
+def profile_stage(stage):
+    if not profiling['enabled']:
+        yield
+        return
+
+    read_start, write_start = io_bytes()
+    rss_start = current_rss()
+    peaks = profiling['peaks']
+    if rss_column == 'Peak RSS (MB)':
+        # The stages this one runs in keep their peak so far before the high-water mark is reset
+        if peaks:
+            peaks[:] = np.fmax(peaks, peak_rss()).tolist()
+        reset_peak_rss()
+        peaks.append(rss_start)
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        read_end, write_end = io_bytes()
+        rss_end = current_rss()
+        rss = rss_end
+        if rss_column == 'Peak RSS (MB)':
+            rss = max(peaks.pop(), peak_rss())
+            peaks[:] = np.fmax(peaks, rss).tolist()
+
+        stage_records.append({'Flood Map': profiling['flood_map'], 'Stage': stage, 'Process': os.getpid(),
+                              'Wall Time (s)': wall, 'CPU Time (s)': cpu, rss_column: rss / 2 ** 20,
+                              'RSS Change (MB)': (rss_end - rss_start) / 2 ** 20,
+                              'Read (MB)': (read_end - read_start) / 2 ** 20,
+                              'Written (MB)': (write_end - write_start) / 2 ** 20})
+
+
+# Turn profiling on for this process and the worker processes of parallel_impact and forget any earlier records
+def start_profiling():
+    stage_records.clear()
+    profiling['peaks'].clear()
+    profiling['enabled'] = True
+
+
+# Turn profiling off. Returns a DataFrame with one row per stage of each flood map (see profile_stage)
+def stop_profiling():
+    import pandas as pd
+
+    profiling['enabled'] = False
+
+    return pd.DataFrame(stage_records, columns=['Flood Map', 'Stage', 'Process', 'Wall Time (s)', 'CPU Time (s)',
+                                                rss_column, 'RSS Change (MB)', 'Read (MB)', 'Written (MB)'])
+
+
+# Total wall time, CPU time, RSS change and bytes read and written and the largest peak RSS (see rss_column) of each
+# stage of a profile from stop_profiling, with the number of times each stage ran
+def profile_summary(profile):
+    summary = profile.groupby('Stage', sort=False).agg(
+        {'Wall Time (s)': 'sum', 'CPU Time (s)': 'sum', rss_column: 'max', 'RSS Change (MB)': 'sum',
+         'Read (MB)': 'sum', 'Written (MB)': 'sum'})
+    summary.insert(0, 'Count', profile.groupby('Stage', sort=False).size())
+
+    return summary.sort_values('Wall Time (s)', ascending=False)
+
+
+# Save a profile from stop_profiling next to the impact CSV file: every stage record to <name>_profile.csv and
+# the summary of each stage (see profile_summary) with the records to <name>_profile.json
+def save_profile(profile, impact_file):
+    name = os.path.splitext(impact_file)[0] + '_profile'
+    profile.to_csv(name + '.csv', index=False)
+
+    with open(name + '.json', 'w') as f:
+        json.dump({'summary': profile_summary(profile).reset_index().to_dict('records'),
+                   'records': profile.to_dict('records')}, f, indent=1)
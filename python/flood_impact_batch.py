@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# coding: utf-8
+#####################################################################################################
+
+# Command line batch runner of the flood impact workflow
+# A job file (TOML or YAML) describes the exposure datasets, the options and every region with its flood maps
+# (a directory of flood maps or a geodatabase), so one run covers a whole country's forecast instead of
+# copying flood_impact_loop_directory.py or flood_impact_loop_gdb.py for each region.
+# The flood maps of every region sharing the same exposure datasets are processed by one pool of workers,
+# which load the exposure datasets once for all of the regions. One CSV file is written per region
+#   Example: python flood_impact_batch.py flood_impact_job.toml
+#   Example: python flood_impact_batch.py flood_impact_job.toml --region Guayubin --workers 4
+# See flood_impact_job.toml for every setting of a job file
+
+#####################################################################################################
+
+# Load All Libraries/Modules
+import argparse
+import datetime
+import hashlib
+import json
+import os
+
+# This will import all of the utility functions and more
+from fldimpact_def import *
+
+# Settings of a job file that are used when the job file does not have them
+# (the same as the settings at the top of flood_impact_loop_directory.py)
+job_defaults = {'path': None, 'output_dir': 'impact/', 'workers': None, 'crop_value': 2, 'osm_cache': True,
+                'incremental': True, 'tile_cache': False, 'memmap_store': False, 'depth_column': None,
+                'depth_bins': list(depth_bins), 'supersample': None, 'crop_runs': False, 'profile': False}
+
+# Settings of a region that are used when the region does not have them
+region_defaults = {'province': '', 'pattern': '*.geojson', 'exclude': [], 'name_column': 'Flood Map Name',
+                   'attributes': {}, 'fields': {}, 'columns': None}
+
+
+#####################################################################################################
+# Job Files
+
+# Read a job file in TOML (.toml) or YAML (.yaml or .yml).
+# TOML does not have a null value, so false or 0 turns off workers and supersample like None does
+def read_job(job_file):
+    if job_file.lower().endswith('.toml'):
+        try:
+            import tomllib
+        except ImportError:
+            # Python before 3.11
+            import tomli as tomllib
+
+        with open(job_file, 'rb') as f:
+            job = tomllib.load(f)
+    else:
+        import yaml
+
+        with open(job_file) as f:
+            job = yaml.safe_load(f)
+
+    job = {**job_defaults, **job}
+    for setting in ('workers', 'supersample'):
+        job[setting] = job[setting] or None
+
+    # Relative paths of the job file are from the directory of the job file unless it has a path
+    if job['path'] is None:
+        job['path'] = os.path.dirname(os.path.abspath(job_file))
+
+    job['regions'] = [{**region_defaults, **region} for region in job.get('regions', [])]
+    if not job['regions']:
+        raise ValueError('The job file %s does not have any regions' % job_file)
+
+    for region in job['regions']:
+        for setting in ('country', 'region', 'flood_maps'):
+            if setting not in region:
+                raise ValueError('A region of the job file %s does not have %s' % (job_file, setting))
+
+    return job
+
+
+# Name of a region in the output files (region + country like the loop scripts)
+def region_label(region):
+    return region['region'] + '_' + region['country']
+
+
+# Croplands, population and OpenStreetMap files and depth column of a region.
+# A region uses the exposure datasets of the job unless it has its own [regions.exposure]
+def region_exposure(job, region):
+    exposure = {**job.get('exposure', {}), **region.get('exposure', {})}
+    for dataset in ('croplands', 'population', 'osm'):
+        if dataset not in exposure:
+            raise ValueError('The region %s does not have a %s dataset' % (region['region'], dataset))
+
+    return (exposure['croplands'], exposure['population'], exposure['osm'],
+            region.get('depth_column', job['depth_column']))
+
+
+# Regions with the same exposure datasets and depth column as (croplands, population, osm, depth column): regions.
+# The flood maps of each group are processed together
+def group_regions(job, regions):
+    groups = {}
+    for region in regions:
+        groups.setdefault(region_exposure(job, region), []).append(region)
+
+    return groups
+
+
+#####################################################################################################
+# Flood Impact
+
+# Catalog of the flood maps of a region (see catalog_flood_maps). flood_maps is a directory or a geodatabase
+def region_catalog(region):
+    return catalog_flood_maps(region['flood_maps'], pattern=region['pattern'], exclude=region['exclude'])
+
+
+# Compute the impact metrics of the flood maps of every region of a group with one pool of workers.
+# Flood maps are named region label/flood map name while they are processed.
+# Returns a dictionary of region label: DataFrame of the impact metrics indexed by flood map name
+def group_impact(job, exposure, regions, catalogs):
+    croplands_path, pop_path, osm_file, depth_column = exposure
+
+    flood_sources = {}
+    for region in regions:
+        label = region_label(region)
+        for name, source in catalog_sources(catalogs[label]).items():
+            flood_sources[label + '/' + name] = source
+
+    options = dict(crop_value=job['crop_value'], osm_cache=job['osm_cache'], tile_cache=job['tile_cache'],
+                   memmap_store=job['memmap_store'], depth_column=depth_column, depth_bins=job['depth_bins'],
+                   supersample=job['supersample'], crop_runs=job['crop_runs'])
+
+    if job['incremental']:
+        # One state file per group of exposure datasets (see incremental_impact). When only some regions of the
+        # group are run the stored flood maps of the other regions are kept for their next run
+        key = json.dumps([os.path.abspath(path) for path in exposure[:3]] + [depth_column])
+        digest = hashlib.sha256(key.encode()).hexdigest()[:12]
+        state_file = os.path.join(job['output_dir'], 'flood_impact_%s.json' % digest)
+        keep_others = len(group_regions(job, job['regions'])[exposure]) > len(regions)
+        metrics = incremental_impact(flood_sources, croplands_path, pop_path, osm_file, state_file, job['workers'],
+                                     keep_others=keep_others, **options)
+    else:
+        metrics = parallel_impact(flood_sources, croplands_path, pop_path, osm_file, job['workers'], **options)
+
+    impacts = {}
+    for region in regions:
+        label = region_label(region)
+        names = list(catalogs[label])
+        impacts[label] = metrics.loc[[label + '/' + name for name in names]].set_axis(names)
+
+    return impacts
+
+
+# DataFrame of the flood impact of a region like the loop scripts: the region, the largest value of each
+# attribute of [regions.attributes] (e.g. 'Max Depth (m)' = 'Depth'), the fields of [regions.fields]
+# (e.g. 'Impact Method' = 'Python') and the impact metrics of every flood map.
+# The columns are in the order of columns when the region has it and the other columns follow
+def region_impact(region, catalog, metrics):
+    name_column = region['name_column']
+    df_impact = metrics.rename_axis(name_column).reset_index()
+
+    for column, attribute in region['attributes'].items():
+        df_impact[column] = df_impact[name_column].map(catalog_max(catalog, attribute))
+    df_impact['Country'] = region['country']
+    df_impact['Province'] = region['province']
+    df_impact['Region'] = region['region']
+    for column, value in region['fields'].items():
+        df_impact[column] = value
+
+    columns = region['columns'] or (['Country', 'Province', 'Region'] + list(region['attributes']) +
+                                    list(region['fields']) + [name_column])
+    missing = [column for column in columns if column not in df_impact]
+    if missing:
+        raise ValueError('The columns %s of the region %s are not in the flood impact' % (missing, region['region']))
+
+    return df_impact[columns + [column for column in df_impact if column not in columns]]
+
+
+# Run every region of a job and write the flood impact of each region to output_dir/<region>_<country>_flood_impact.csv.
+# Returns a dictionary of region label: CSV file
+def run_job(job, regions=None):
+    regions = [region for region in job['regions'] if not regions or region['region'] in regions]
+    if not regions:
+        raise ValueError('None of the regions of the job were selected')
+
+    os.makedirs(job['output_dir'], exist_ok=True)
+
+    # Scan the flood maps of every region once. The catalog of each directory or geodatabase is kept next to it
+    catalogs = {region_label(region): region_catalog(region) for region in regions}
+
+    impact_files = {}
+    for exposure, group in group_regions(job, regions).items():
+        print("Computing %d flood maps of %d regions with %s" %
+              (sum(len(catalogs[region_label(region)]) for region in group), len(group), ', '.join(exposure[:3])))
+        impacts = group_impact(job, exposure, group, catalogs)
+
+        for region in group:
+            label = region_label(region)
+            impact_files[label] = os.path.join(job['output_dir'], label + '_flood_impact.csv')
+            region_impact(region, catalogs[label], impacts[label]).to_csv(impact_files[label], index=False,
+                                                                          header=True)
+
+    return impact_files
+
+
+#####################################################################################################
+# Everything below only runs when this script is executed.
+# The worker processes import this script and must not run it again
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compute the flood impact of every region of a job file')
+    parser.add_argument('job_file', help='TOML or YAML job file with the exposure datasets and regions')
+    parser.add_argument('--region', action='append', help='only run this region (can be given more than once)')
+    parser.add_argument('--workers', type=int, help='worker processes (overrides the job file)')
+    parser.add_argument('--full', action='store_true', help='compute every flood map again (not incremental)')
+    parser.add_argument('--profile', action='store_true', help='save the time and memory of each stage')
+    args = parser.parse_args()
+
+    job = read_job(args.job_file)
+    if args.workers:
+        job['workers'] = args.workers
+    if args.full:
+        job['incremental'] = False
+    if args.profile:
+        job['profile'] = True
+
+    os.chdir(job['path'])
+    print("Current Working Directory ", os.getcwd())
+
+    begin_time = datetime.datetime.now()
+    if job['profile']:
+        start_profiling()
+
+    impact_files = run_job(job, args.region)
+    for label, impact_file in impact_files.items():
+        print("%s: %s" % (label, impact_file))
+
+    # Export the time and memory of each stage next to the CSV files
+    if job['profile']:
+        save_profile(stop_profiling(), os.path.join(job['output_dir'], 'flood_impact.csv'))
+
+    print(f"\nThe runtime for the job was:\n{datetime.datetime.now() - begin_time}")
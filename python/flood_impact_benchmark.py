@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+# coding: utf-8
+#####################################################################################################
+
+# Benchmark of the flood impact workflow with synthetic datasets
+# A croplands-like class raster, a WorldPop-like population raster, an OpenStreetMap point shapefile with
+# 'other_tags', flood polygons (GeoJSON) and a flood raster are generated at the scale given on the command line.
+# Each function of fldimpact_def.py and the whole loop over every flood map are then timed and the
+# throughput is reported in events per minute and pixels per second so regressions can be tracked
+#   Example: python flood_impact_benchmark.py --events 50 --crop-size 6000 --points 200000 --output benchmark.csv
+# The same --seed always generates the same datasets
+
+#####################################################################################################
+
+# Load All Libraries/Modules
+import argparse
+import glob
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import rasterio as rio
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+# This will import all of the utility functions and more
+from fldimpact_def import *
+
+# Extent of the synthetic datasets in EPSG:4326 (west, north) and its size in degrees
+origin = (-76.0, -6.0)
+extent = 1.0
+
+
+#####################################################################################################
+# Synthetic datasets
+
+# Write a single band GeoTIFF over the extent a strip of rows at a time so large rasters do not need to fit in memory.
+# strip(row, rows) returns the values of that many rows starting at row
+def write_raster(output_file, size, dtype, nodata, strip, strip_rows=512):
+    with rio.open(output_file, 'w', driver='GTiff', height=size, width=size, count=1, dtype=dtype,
+                  crs='EPSG:4326', transform=from_origin(origin[0], origin[1], extent / size, extent / size),
+                  nodata=nodata, tiled=True, blockxsize=256, blockysize=256, compress='deflate') as dst:
+        for row in range(0, size, strip_rows):
+            rows = min(strip_rows, size - row)
+            dst.write(strip(row, rows), 1, window=Window(0, row, size, rows))
+
+
+# Croplands-like class raster: fields of 8 x 8 cells of class 0 to 3, where 2 is cultivated agriculture
+def make_croplands(output_file, size, rng):
+    fields = rng.integers(0, 4, (size // 8 + 1, size // 8 + 1)).astype('uint8')
+
+    def strip(row, rows):
+        return np.repeat(np.repeat(fields, 8, axis=0), 8, axis=1)[row:row + rows, :size]
+
+    write_raster(output_file, size, 'uint8', 255, strip)
+
+
+# WorldPop-like population raster: people per cell with 20% of the cells being noData
+def make_population(output_file, size, rng):
+    def strip(row, rows):
+        pop = rng.gamma(0.5, 10, (rows, size)).astype('float32')
+        pop[rng.random((rows, size)) < 0.2] = -99999
+        return pop
+
+    write_raster(output_file, size, 'float32', -99999, strip)
+
+
+# OpenStreetMap-like point shapefile with the amenity in 'other_tags' for most of the points
+def make_osm(output_file, points, rng):
+    amenities = np.array([amenity for amenity, group in amenity_search] + ['unknown_amenity'])
+    amenity = amenities[rng.integers(len(amenities), size=points)]
+    tags = np.char.add(np.char.add('"amenity"=>"', amenity), '","opening_hours"=>"24/7"').astype(object)
+    tags[rng.random(points) < 0.3] = None
+
+    lon = origin[0] + rng.random(points) * extent
+    lat = origin[1] - rng.random(points) * extent
+    osm_pts = gpd.GeoDataFrame({'osm_id': np.arange(points).astype(str), 'name': None, 'other_tags': tags},
+                               geometry=gpd.points_from_xy(lon, lat), crs='EPSG:4326')
+    osm_pts.to_file(output_file)
+
+
+# Flood map polygons: a cluster of circles with a 'Depth' and 'rango' somewhere in the extent.
+# Every other flood map is saved in UTM so the flood maps have to be reprojected like real HAND maps
+def make_flood_map(output_file, polygons, radius, rng, utm=False):
+    center = origin[0] + (0.2 + 0.6 * rng.random()) * extent, origin[1] - (0.2 + 0.6 * rng.random()) * extent
+    lon = center[0] + rng.normal(0, 2 * radius, polygons)
+    lat = center[1] + rng.normal(0, 2 * radius, polygons)
+    circles = gpd.points_from_xy(lon, lat).buffer(radius * (0.3 + rng.random(polygons)), 32)
+
+    depth = rng.gamma(2, 0.4, polygons).round(2)
+    flood_map = gpd.GeoDataFrame({'Depth': depth, 'rango': np.digitize(depth, [0.5, 1, 2]) + 1},
+                                 geometry=circles, crs='EPSG:4326')
+    if utm:
+        flood_map = flood_map.to_crs(32718)
+    flood_map.to_file(output_file, driver='GeoJSON')
+
+
+# Flood raster (e.g. a HAND map): 1 where flooded and 0 elsewhere within circles around the middle of the extent
+def make_flood_raster(output_file, size, rng):
+    centers = rng.random((20, 2)) * size * 0.6 + size * 0.2
+    radius = size * (0.02 + 0.05 * rng.random(20))
+
+    def strip(row, rows):
+        y, x = np.mgrid[row:row + rows, 0:size]
+        flooded = np.zeros((rows, size), dtype=bool)
+        for (cx, cy), r in zip(centers, radius):
+            flooded |= (x - cx) ** 2 + (y - cy) ** 2 < r ** 2
+        return flooded.astype('uint8')
+
+    write_raster(output_file, size, 'uint8', None, strip)
+
+
+# Generate every synthetic dataset in data_dir. Returns the paths of the datasets
+def make_datasets(data_dir, args):
+    rng = np.random.default_rng(args.seed)
+    paths = {'croplands': os.path.join(data_dir, 'croplands.tif'), 'population': os.path.join(data_dir, 'pop.tif'),
+             'osm': os.path.join(data_dir, 'osm_points.shp'), 'flood_dir': os.path.join(data_dir, 'flood_maps'),
+             'flood_raster': os.path.join(data_dir, 'flood_raster.tif')}
+
+    make_croplands(paths['croplands'], args.crop_size, rng)
+    make_population(paths['population'], args.pop_size, rng)
+    make_osm(paths['osm'], args.points, rng)
+    make_flood_raster(paths['flood_raster'], args.raster_size, rng)
+
+    os.makedirs(paths['flood_dir'], exist_ok=True)
+    for event in range(args.events):
+        make_flood_map(os.path.join(paths['flood_dir'], 'event_%03d.geojson' % event), args.polygons,
+                       args.radius, rng, utm=event % 2 == 1)
+
+    return paths
+
+
+#####################################################################################################
+# Timing
+
+# Run func repeat times and record the fastest run with the events/min and pixels/s it stands for.
+# Returns the result of the last run
+def timed(results, name, func, events=0, pixels=0, repeat=1):
+    seconds = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = func()
+        seconds = min(seconds, time.perf_counter() - start)
+
+    results.append({'Benchmark': name, 'Seconds': seconds, 'Events': events, 'Pixels': pixels,
+                    'Events/min': events / seconds * 60 if events else np.nan,
+                    'Pixels/s': pixels / seconds if pixels else np.nan})
+    print('%-40s %10.3f s' % (name, seconds))
+
+    return value
+
+
+# Number of cells of an exposure raster read for each flood map
+def window_pixels(input_rasterfile, flood_maps):
+    with rio.open(input_rasterfile) as src:
+        windows = [flood_window(src, flood_map) for flood_map in flood_maps]
+
+    return sum(window.width * window.height for window in windows)
+
+
+# Time each function of fldimpact_def.py and the whole loop over every flood map.
+# Every cache, index and state file is written to work_dir, so the datasets in paths are never changed
+def run_benchmarks(paths, args, work_dir):
+    results = []
+
+    # The OpenStreetMap cache is written next to the shapefile, so the shapefile is copied to work_dir first
+    for sidecar in glob.glob(os.path.splitext(paths['osm'])[0] + '.*'):
+        shutil.copy(sidecar, work_dir)
+    paths = dict(paths, osm=os.path.join(work_dir, os.path.basename(paths['osm'])))
+
+    sources = {path: path for path in sorted(glob.glob(os.path.join(paths['flood_dir'], '*.geojson')))}
+    events = len(sources)
+
+    # Flood maps
+    index_file = os.path.join(work_dir, 'flood_map_index.json')
+    timed(results, 'catalog_flood_maps', lambda: catalog_flood_maps(paths['flood_dir'], index_file), events)
+    flood_maps = timed(results, 'read_flood_map',
+                       lambda: {name: read_flood_map(source) for name, source in sources.items()}, events)
+    maps = list(flood_maps.values())
+    timed(results, 'repair_geometries', lambda: [repair_geometries(flood_map) for flood_map in maps], events)
+    with rio.open(paths['flood_raster']) as src:
+        raster_pixels = src.width * src.height
+    timed(results, 'raster2flood_map', lambda: raster2flood_map(paths['flood_raster']), 1, raster_pixels)
+
+    # Exposure rasters
+    crop_pixels = window_pixels(paths['croplands'], maps)
+    pop_pixels = window_pixels(paths['population'], maps)
+    crop_grids = timed(results, 'read_exposure (croplands)',
+                       lambda: [read_exposure(paths['croplands'], [flood_map]) for flood_map in maps],
+                       events, crop_pixels, args.repeat)
+    pop_grids = timed(results, 'read_exposure (population)',
+                      lambda: [read_exposure(paths['population'], [flood_map]) for flood_map in maps],
+                      events, pop_pixels, args.repeat)
+
+    tile_dir = os.path.join(work_dir, 'tiles')
+    timed(results, 'read_exposure_tiles (first run)',
+          lambda: [read_exposure_tiles(paths['croplands'], [flood_map], 'crop', cache_dir=tile_dir)
+                   for flood_map in maps], events, crop_pixels)
+    exposure_tiles.clear()
+    timed(results, 'read_exposure_tiles (from disk)',
+          lambda: [read_exposure_tiles(paths['croplands'], [flood_map], 'crop', cache_dir=tile_dir)
+                   for flood_map in maps], events, crop_pixels)
+
+    store_dir = os.path.join(work_dir, 'store')
+    timed(results, 'exposure_store (build)', lambda: exposure_store(paths['croplands'], store_dir),
+          0, args.crop_size ** 2)
+    store = exposure_store(paths['croplands'], store_dir)
+    timed(results, 'read_exposure_store', lambda: [read_exposure_store(store, [flood_map]) for flood_map in maps],
+          events, crop_pixels, args.repeat)
+
+    runs_dir = os.path.join(work_dir, 'runs')
+    crop_runs = timed(results, 'read_crop_runs (build)', lambda: read_crop_runs(paths['croplands'], runs_dir=runs_dir),
+                      0, args.crop_size ** 2)
+
+    # Zonal statistics
+    pairs = list(zip(maps, crop_grids, pop_grids))
+    timed(results, 'crop_sum', lambda: [crop_sum(grid, flood_map) for flood_map, grid, _ in pairs],
+          events, crop_pixels, args.repeat)
+    timed(results, 'pop_sum', lambda: [pop_sum(grid, flood_map) for flood_map, _, grid in pairs],
+          events, pop_pixels, args.repeat)
+    timed(results, 'crop_sum (supersample=4)',
+          lambda: [crop_sum(grid, flood_map, supersample=4) for flood_map, grid, _ in pairs],
+          events, crop_pixels, args.repeat)
+    timed(results, 'crop_depth_sum',
+          lambda: [crop_depth_sum(grid, flood_map, 'Depth') for flood_map, grid, _ in pairs],
+          events, crop_pixels, args.repeat)
+    timed(results, 'crop_sum (crop runs)', lambda: [crop_sum(crop_runs, flood_map) for flood_map in maps],
+          events, crop_pixels, args.repeat)
+
+    # Infrastructure
+    osm_pts = timed(results, 'read_osm', lambda: read_osm(paths['osm']))
+    timed(results, 'cache_osm (build)', lambda: cache_osm(paths['osm']))
+    timed(results, 'read_osm (cache)', lambda: read_osm(paths['osm'], cache=True), repeat=args.repeat)
+    timed(results, 'classify_amenities', lambda: classify_amenities(osm_pts['Amenity']), repeat=args.repeat)
+    osm_pts.sindex
+    timed(results, 'osm_sum', lambda: [osm_sum(osm_pts, flood_map) for flood_map in maps], events,
+          repeat=args.repeat)
+
+    # End to end over every flood map
+    exposure = (paths['croplands'], paths['population'], paths['osm'])
+    timed(results, 'parallel_impact (workers=1)', lambda: parallel_impact(sources, *exposure, workers=1),
+          events, crop_pixels + pop_pixels)
+    timed(results, 'parallel_impact (workers=%s)' % args.workers,
+          lambda: parallel_impact(sources, *exposure, workers=args.workers, osm_cache=True),
+          events, crop_pixels + pop_pixels)
+
+    state_file = os.path.join(work_dir, 'state.json')
+    timed(results, 'incremental_impact (first run)',
+          lambda: incremental_impact(sources, *exposure, state_file, args.workers, osm_cache=True),
+          events, crop_pixels + pop_pixels)
+    timed(results, 'incremental_impact (no changes)',
+          lambda: incremental_impact(sources, *exposure, state_file, args.workers, osm_cache=True), events)
+
+    return pd.DataFrame(results)
+
+
+#####################################################################################################
+# Everything below only runs when this script is executed.
+# The worker processes import this script and must not run it again
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the flood impact workflow with synthetic datasets')
+    parser.add_argument('--events', type=int, default=20, help='number of flood maps')
+    parser.add_argument('--polygons', type=int, default=50, help='number of polygons in each flood map')
+    parser.add_argument('--radius', type=float, default=0.01, help='typical flood polygon radius in degrees')
+    parser.add_argument('--crop-size', type=int, default=4000, help='rows and columns of the croplands raster')
+    parser.add_argument('--pop-size', type=int, default=1200, help='rows and columns of the population raster')
+    parser.add_argument('--raster-size', type=int, default=2000, help='rows and columns of the flood raster')
+    parser.add_argument('--points', type=int, default=100000, help='number of OpenStreetMap points')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (all cores by default)')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of the faster benchmarks (fastest is kept)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic datasets')
+    parser.add_argument('--data-dir', help='directory for the datasets (temporary and deleted by default)')
+    parser.add_argument('--output', help='CSV file to save the results to')
+    args = parser.parse_args()
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='flood_impact_benchmark_')
+    os.makedirs(data_dir, exist_ok=True)
+    # A new work directory for the caches on every run so no run starts from the caches of an earlier one
+    work_dir = tempfile.mkdtemp(prefix='flood_impact_benchmark_work_')
+
+    try:
+        begin_time = time.perf_counter()
+        paths = make_datasets(data_dir, args)
+        print("Generated the synthetic datasets in %.1f s in %s\n" % (time.perf_counter() - begin_time, data_dir))
+
+        results = run_benchmarks(paths, args, work_dir)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        if args.data_dir is None:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    print()
+    print(results.to_string(index=False, float_format=lambda value: '%.3f' % value))
+
+    if args.output:
+        results.to_csv(args.output, index=False)
@@ -22,6 +22,9 @@
 
 # This is to get flood extent map shapefile from a geodatabase
 # for reading a geodatabase for shapefiles like from ArcGIS Pro
+# fiona is not imported by fldimpact_def.py, so it is imported here
+import fiona
+
 floodmap_gdb = "Chazuta_test.gdb"
 layer = fiona.listlayers(floodmap_gdb)
 print(layer)
@@ -29,8 +32,8 @@ print(layer)
 layer_file = input("Type the layer from the printed list that reflects your flood map:\t")
 
 # This will extract the flood map layer and upload it to a GeoPandas Dataframe and gathers the CRS
-for layer in layer:
-    flood_map = gpd.read_file(floodmap_gdb, layer = layer_file)
+# (read_flood_map((floodmap_gdb, layer_file)) from fldimpact_def.py does the same)
+flood_map = gpd.read_file(floodmap_gdb, layer=layer_file)
 new_crs = flood_map.crs
 
 
@@ -54,6 +57,29 @@ fld_json = json.load(f)
 ############################
 
 # Let us graph stuff
+# This goes at the end of flood_impact.py, which has flood_map, osm_cl_df, croplands_path, pop_path and plot_title
+import matplotlib.pyplot as plt
+import seaborn as sns
+import contextily as ctx
+
+# Setting consistent plotting style throughout script
+sns.set_style("dark")
+sns.set(font_scale=1.5)
+
+
+# Points at the center of the cells of an exposure raster within the flood map whose value passes keep
+def flooded_cells(input_rasterfile, flood_map, keep):
+    grid = read_exposure(input_rasterfile, [flood_map])
+    array, transform, inside = grid_flood(grid, flood_map)
+    rows, cols = np.nonzero(inside & keep(array.filled(0)))
+    xs, ys = transform * (cols + 0.5, rows + 0.5)
+
+    return gpd.GeoDataFrame(geometry=gpd.points_from_xy(xs, ys), crs=grid['crs']).to_crs(flood_map.crs)
+
+
+# The cultivated agriculture cells (cell value 2) and the populated cells within the flood map
+clipped_ag = flooded_cells(croplands_path, flood_map, lambda values: values == 2)
+clipped_pop = flooded_cells(pop_path, flood_map, lambda values: values > 0)
 
 # Plot Flood Extent area without flood (alpha=0)
 fig, ax = plt.subplots(figsize=(12, 12))
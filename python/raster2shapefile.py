@@ -7,19 +7,10 @@ import os
 # What is the path of your working directory
 # path = input("Path of working directory:\t")
 path = "/Users/evan/flood_map_py/"
-os.chdir(path)
-print("Current Working Directory ", os.getcwd())
 
 
 # # Load Library
-# We do not need all of these, but it's something to start with.
-
-from osgeo import gdal, ogr
-import rasterio as rio
-
-import numpy as np
-import geopandas as gpd
-from fiona.crs import from_epsg
+# GDAL is only imported by raster2flood_map when the raster is converted
 
 # This will import all of the utility functions and more
 from fldimpact_def import *
@@ -30,38 +21,20 @@ from fldimpact_def import *
 # fld_file = input("What is the location of the flood map raster file?:\t")
 fld_file = 'Thailand_Oct2021/Flood_Nakhon_Sawan_100m.tif'
 
-# These are pre-named and it assumed there is a folder called temp in the os path previously stated.
-# You can grab code from flood_impact.py for creating and deleting a temp folder
-reclass_file ='temp/fld_reclass.tif'
-
-reclass_raster(fld_file, reclass_file, 1, 1, 1, 0)
-
-null_file = "temp/fld_nodata.tif"
-
-ras_Null(reclass_file, null_file, 0)
-
-
 # # Convert Raster to Polygon
+
+# The flood map raster is reclassified (cells >= 1 become 1 and all others 0), the cells of 0 are made noData,
+# it is converted to polygons, the geometries are fixed if needed and the polygons are reprojected to EPSG:4326
+# all in memory. The polygons are written to the flood_map shapefile once at the end.
 # flood_map = input("Location to put the flood map:\t")
 flood_map = 'temp/fld_poly_thai_100m.shp'
 
-ras2poly(null_file, flood_map, 0)
-
-
-# # Fix the Geometry if needed
+# Only runs when this script is executed, so importing it does not change the working directory
+if __name__ == '__main__':
+    os.chdir(path)
+    print("Current Working Directory ", os.getcwd())
 
-# Check to see if the geometries are valid
-fld_map = gpd.read_file(flood_map)
-fld_map.is_valid
-
-# Ocassionally the geometries are not valid so fix geometries
-fix_geometries(flood_map)
-
-# Since the data we have is in ESPG: 4236, force the shapefile to be same projection
-fld_map = gpd.read_file(flood_map)
-data = fld_map.to_crs(epsg=4326)
-# write shp file
-data.to_file(flood_map)
+    fld_map = raster2flood_map(fld_file, flood_map, 1, 1, 1, 0, null_value=0, epsg=4326)
 
 
 # ### Setting consistent plotting style throughout notebook
@@ -73,6 +46,7 @@ sns.set(font_scale=1.5)
 
 import matplotlib.pyplot as plt
 import contextily as ctx
+import geopandas as gpd
 
 
 
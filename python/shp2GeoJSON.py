@@ -3,83 +3,53 @@
 
 import os
 path = "/Users/evan/Utah_County_Boundaries/"
-os.chdir(path)
-print("Current Working Directory ", os.getcwd())
 
-from osgeo import ogr, gdal
-import rasterio as rio
-from rasterio.mask import mask
+import json
 
-import pandas as pd
+# Only geopandas is needed to write the GeoJSON file. The plotting libraries are imported
+# in the commented plotting code below when it is used
 import geopandas as gpd
-import numpy as np
-
-import georasters as gr
-
-from fiona.crs import from_epsg
-from shapely.geometry import box
-
-# for plotting
-from rasterio import plot
-from rasterio.plot import show
-from rasterio.plot import show_hist
-import matplotlib.pyplot as plt
-import seaborn as sns
-import contextily as ctx
-
-# for reading a geodatabase
-import fiona
 
 # flood_file = input("Flood map file name:\t")
 flood_file = 'utah_state.shp'
 
-flood_map = gpd.read_file(flood_file)
-'''
-fig, ax = plt.subplots(figsize = (12,12))
-
-ax.set_xlabel('Longitude')
-ax.set_ylabel('Latitude')
-ax.set_title('Flood Extent Map');
-
-flood_map.plot(ax=ax)
-#ctx.add_basemap(ax, crs = flood_map.crs, source = ctx.providers.OpenStreetMap.Mapnik)
-plt.show()
-'''
-import json
-import geojson
-from shapely.geometry import shape
-
-import shapefile
-import pygeoif
-
-import shapely.wkt
-import shapely.geometry
-
-
-# This will import all of the utility functions and more
-from fldimpact_def import *
-
 # Will want to change the names of the geojson files
 json_file = 'Utah.geojson'
-flood_map.to_file(json_file, driver='GeoJSON')
-f = open(json_file,)
 
-fld_json = json.load(f)
+# Only runs when this script is executed, so importing it does not change the working directory
+if __name__ == '__main__':
+    os.chdir(path)
+    print("Current Working Directory ", os.getcwd())
 
+    flood_map = gpd.read_file(flood_file)
+    '''
+    import matplotlib.pyplot as plt
+    import contextily as ctx
 
-'''print(fld_json)
+    fig, ax = plt.subplots(figsize = (12,12))
 
+    ax.set_xlabel('Longitude')
+    ax.set_ylabel('Latitude')
+    ax.set_title('Flood Extent Map');
 
+    flood_map.plot(ax=ax)
+    #ctx.add_basemap(ax, crs = flood_map.crs, source = ctx.providers.OpenStreetMap.Mapnik)
+    plt.show()
+    '''
+    flood_map.to_file(json_file, driver='GeoJSON')
+    with open(json_file) as f:
+        fld_json = json.load(f)
 
-fld_map = gpd.read_file('Utah.geojson')
+    '''print(fld_json)
 
-fig, ax = plt.subplots(figsize = (12,12))
+    fld_map = gpd.read_file('Utah.geojson')
 
+    fig, ax = plt.subplots(figsize = (12,12))
 
-ax.set_xlabel('Longitude')
-ax.set_ylabel('Latitude')
-ax.set_title('Flood Extent Map');
+    ax.set_xlabel('Longitude')
+    ax.set_ylabel('Latitude')
+    ax.set_title('Flood Extent Map');
 
-fld_map.plot(ax=ax)
-ctx.add_basemap(ax, crs = fld_map.crs, source = ctx.providers.OpenStreetMap.Mapnik)
-plt.show()'''
\ No newline at end of file
+    fld_map.plot(ax=ax)
+    ctx.add_basemap(ax, crs = fld_map.crs, source = ctx.providers.OpenStreetMap.Mapnik)
+    plt.show()'''
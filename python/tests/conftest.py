@@ -0,0 +1,57 @@
+# The tests import fldimpact_def from the python directory like the scripts do
+import os
+import sys
+
+import geopandas as gpd
+import numpy as np
+import pytest
+import rasterio as rio
+from rasterio.transform import from_origin
+from shapely.geometry import MultiPolygon, Point, box
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+# Synthetic population and croplands rasters, OpenStreetMap points and flood maps of 6 events over them
+@pytest.fixture(scope='session')
+def data(tmp_path_factory):
+    path = tmp_path_factory.mktemp('data')
+    rng = np.random.default_rng(0)
+
+    pop = (rng.random((300, 400)) * 20).astype('float32')
+    pop[rng.random(pop.shape) < 0.1] = -99999
+    with rio.open(path / 'pop.tif', 'w', driver='GTiff', height=300, width=400, count=1, dtype='float32',
+                  crs='EPSG:4326', transform=from_origin(-76.0, -6.0, 0.001, 0.001), nodata=-99999) as dst:
+        dst.write(pop, 1)
+
+    crop = rng.integers(0, 4, (900, 1200)).astype('uint8')
+    crop[rng.random(crop.shape) < 0.05] = 255
+    with rio.open(path / 'crop.tif', 'w', driver='GTiff', height=900, width=1200, count=1, dtype='uint8',
+                  crs='EPSG:4326', transform=from_origin(-76.0, -6.0, 1 / 3000, 1 / 3000), nodata=255) as dst:
+        dst.write(crop, 1)
+
+    amenities = ['school', 'bank', 'cafe', 'hospital', 'parking', 'toilets', 'police', 'recycling', None]
+    tags = [None if amenity is None else '"amenity"=>"%s"' % amenity
+            for amenity in rng.choice(np.array(amenities, dtype=object), 2000)]
+    osm = gpd.GeoDataFrame({'osm_id': [str(i) for i in range(2000)], 'other_tags': tags},
+                           geometry=gpd.points_from_xy(-76 + rng.random(2000) * 0.4, -6 - rng.random(2000) * 0.3),
+                           crs='EPSG:4326')
+    osm.to_file(path / 'osm.shp')
+
+    def flood_map(geoms, depth, crs='EPSG:4326'):
+        return gpd.GeoDataFrame({'Depth': depth}, geometry=geoms, crs='EPSG:4326').to_crs(crs)
+
+    ring = Point(-75.8, -6.15).buffer(0.05).difference(Point(-75.8, -6.15).buffer(0.02))
+    events = {
+        'circle': flood_map([Point(-75.85, -6.1).buffer(0.04)], [0.3]),
+        'overlapping': flood_map([Point(-75.75, -6.2).buffer(0.03), Point(-75.73, -6.19).buffer(0.03)], [0.8, 1.6]),
+        'utm': flood_map([Point(-75.7, -6.05).buffer(0.02), Point(-75.9, -6.25).buffer(0.03)], [0.2, 1.2],
+                         'EPSG:32718'),
+        'hole': flood_map([ring], [0.6]),
+        'multipolygon': flood_map([MultiPolygon([box(-75.99, -6.29, -75.95, -6.2), box(-75.65, -6.1, -75.61, -6.02)])],
+                                  [2.0]),
+        'edge': flood_map([Point(-76.0, -6.1).buffer(0.03)], [0.4]),
+    }
+
+    return {'pop': str(path / 'pop.tif'), 'crop': str(path / 'crop.tif'), 'osm': str(path / 'osm.shp'),
+            'events': events}
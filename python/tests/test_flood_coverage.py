@@ -0,0 +1,73 @@
+# Checks the coverage labels of the cells and blocks of a grid against the area of every cell covered by the flood
+# polygons and the weighted sums over the blocks against the sums over every cell
+import numpy as np
+import pytest
+import shapely
+from rasterio.transform import Affine
+from rasterio.windows import bounds as window_bounds
+
+import fldimpact_def as fd
+
+
+# Flood polygons of an event on the croplands grid under it, with the coverage of the grid and the fraction of
+# every cell covered by the polygons (intersection area / cell area, only measured for the cells on the boundary)
+def event_coverage(data, name, bins=None):
+    flood_map = data['events'][name]
+    grid = fd.read_exposure(data['crop'], [flood_map])
+    crop, transform, window = fd.grid_window(grid, flood_map)
+    column = 'Depth' if bins is not None else None
+    shapes = fd.flood_shapes(flood_map, grid['crs'], window_bounds(window, grid['transform']), column)
+    coverage = fd.flood_coverage(shapes, (window.height, window.width), transform, 4, bins)
+
+    rows, cols = np.indices((window.height, window.width))
+    west, north = transform * (cols, rows)
+    east, south = transform * (cols + 1, rows + 1)
+    cells = shapely.box(west, south, east, north)
+    union = shapely.union_all([shape[0] if isinstance(shape, tuple) else shape for shape in shapes])
+    shapely.prepare(union)
+
+    area = shapely.contains(union, cells).astype(float)
+    edge = shapely.intersects(union, cells) & (area == 0)
+    area[edge] = shapely.area(shapely.intersection(cells[edge], union)) / shapely.area(cells[edge])
+
+    return crop, transform, grid['crs'], coverage, area
+
+
+@pytest.mark.parametrize('name', ['circle', 'overlapping', 'utm', 'hole', 'multipolygon', 'edge'])
+def test_labels_match_cell_area(data, name):
+    crop, transform, crs, coverage, area = event_coverage(data, name)
+    labels, blocks = coverage['labels'], coverage['blocks']
+
+    assert np.allclose(area[labels == fd.coverage_inside], 1)
+    assert np.allclose(area[labels == fd.coverage_outside], 0)
+    assert np.all(labels[(area > 1e-9) & (area < 1 - 1e-9)] == fd.coverage_partial)
+
+    # Whole blocks have the label of every cell in them and partial blocks have a partial cell
+    for row, col in np.ndindex(blocks.shape):
+        cells = labels[row * 16:(row + 1) * 16, col * 16:(col + 1) * 16]
+        if blocks[row, col] == fd.coverage_partial:
+            assert np.any(cells == fd.coverage_partial)
+        else:
+            assert np.all(cells == blocks[row, col])
+
+    # The fraction of the partial cells is estimated and the other cells are 0 or 1
+    assert np.abs(coverage['fraction'] - area).max() < 0.5
+    assert np.array_equal(coverage['fraction'][labels != fd.coverage_partial],
+                          (labels[labels != fd.coverage_partial] == fd.coverage_inside).astype('float32'))
+
+
+def test_sums_match_dense_sums(data):
+    for name in data['events']:
+        crop, transform, crs, coverage, _ = event_coverage(data, name, fd.depth_bins)
+        values = np.random.default_rng(0).random(coverage['fraction'].shape)
+
+        total, by_bin = fd.coverage_sums(values, coverage)
+        assert total == pytest.approx(float(np.sum(values * coverage['fraction'])), rel=1e-9), name
+        assert by_bin == pytest.approx([float(np.sum(values * bin_fraction))
+                                        for bin_fraction in coverage['bin_fractions']], rel=1e-9), name
+
+
+def test_empty_coverage():
+    coverage = fd.flood_coverage([], (40, 50), Affine.identity(), 4, fd.depth_bins)
+    assert coverage['blocks'].shape == (3, 4)
+    assert fd.coverage_sums(np.ones((40, 50)), coverage) == (0, [0, 0, 0])
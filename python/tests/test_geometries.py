@@ -0,0 +1,27 @@
+# Checks that repairing the flood polygons only leaves polygons, even where a ring collapsed
+import geopandas as gpd
+import pytest
+from shapely.geometry import Polygon
+
+import fldimpact_def as fd
+
+
+@pytest.mark.parametrize('method', ['buffer', 'make_valid'])
+def test_repair_keeps_polygons(method):
+    fld_map = gpd.GeoDataFrame({'Value': [1, 1, 1]}, geometry=[
+        # A collapsed ring, which make_valid turns into lines
+        Polygon([(0, 0), (1, 1), (2, 2), (0, 0)]),
+        # A bow tie
+        Polygon([(0, 0), (2, 2), (2, 0), (0, 2), (0, 0)]),
+        Polygon([(5, 5), (6, 5), (6, 6), (5, 6)]),
+    ], crs='EPSG:4326')
+
+    fixed, n_fixed = fd.repair_geometries(fld_map, method)
+
+    assert n_fixed == 2
+    assert fixed.is_valid.all()
+    assert fixed.geom_type.isin(['Polygon', 'MultiPolygon']).all()
+    assert fixed.geometry.iloc[0].is_empty
+    # buffer(0) only keeps one of the two triangles of a bow tie
+    assert fixed.geometry.iloc[1].area == pytest.approx(2 if method == 'make_valid' else 1)
+    assert fixed.geometry.iloc[2].equals(fld_map.geometry.iloc[2])
@@ -0,0 +1,76 @@
+# Checks that the in-memory impact metrics give the same results as the original workflow, which clipped the
+# exposure rasters to the flood map extent, converted every cell to a point and intersected the points with gpd.clip,
+# and that every way of loading the exposure datasets gives the same impact metrics
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+import rasterio as rio
+from rasterio.mask import mask
+from shapely.geometry import box, mapping
+
+import fldimpact_def as fd
+
+
+# Points at the center of the cells of a raster within the extent of the flood map that pass keep, with their values,
+# clipped by the flood map in EPSG:4326 (ras2shp_extent -> reclass/null -> raster to points -> gpd.clip)
+def clipped_cells(raster_file, flood_map, keep):
+    with rio.open(raster_file) as src:
+        extent = gpd.GeoSeries([box(*flood_map.total_bounds)], crs=flood_map.crs).to_crs(src.crs)
+        out_img, out_transform = mask(src, [mapping(extent.iloc[0])], crop=True)
+        nodata = src.nodata
+
+    values = out_img[0]
+    rows, cols = np.nonzero(keep(values) & (values != nodata))
+    xs, ys = out_transform * (cols + 0.5, rows + 0.5)
+    pts = gpd.GeoDataFrame({'value': values[rows, cols]}, geometry=gpd.points_from_xy(xs, ys), crs='EPSG:4326')
+
+    return gpd.clip(pts, flood_map.to_crs('EPSG:4326'))
+
+
+def test_population_matches_clip(data):
+    for name, flood_map in data['events'].items():
+        clipped = clipped_cells(data['pop'], flood_map, lambda values: np.ones(values.shape, dtype=bool))
+        expected = int(clipped['value'].astype(int).sum())
+
+        grid = fd.read_exposure(data['pop'], [flood_map])
+        assert fd.pop_sum(grid, flood_map) == expected, name
+
+
+def test_cropland_cells_match_clip(data):
+    for name, flood_map in data['events'].items():
+        expected = len(clipped_cells(data['crop'], flood_map, lambda values: values == 2))
+
+        crop, transform, inside = fd.grid_flood(fd.read_exposure(data['crop'], [flood_map]), flood_map)
+        assert fd.crop_rows(crop, inside).sum() == expected, name
+
+
+@pytest.mark.parametrize('depth_column, supersample', [(None, None), ('Depth', None), ('Depth', 4)])
+def test_exposure_backends_match(data, tmp_path, depth_column, supersample):
+    options = {'depth_column': depth_column, 'supersample': supersample}
+    expected = fd.batch_impact(data['events'], data['crop'], data['pop'], data['osm'], **options)
+
+    backends = {'tile cache': {'tile_cache': str(tmp_path / 'tiles')},
+                'memmap store': {'memmap_store': str(tmp_path / 'store')},
+                'crop runs': {'crop_runs': str(tmp_path / 'runs')}}
+    for name, backend in backends.items():
+        # The second run loads what the first run saved
+        for _ in range(2):
+            impact = fd.batch_impact(data['events'], data['crop'], data['pop'], data['osm'], **options, **backend)
+            pd.testing.assert_frame_equal(impact, expected, obj=name)
+
+
+# A flood map without any features (e.g. an ensemble member with no flooding) has zero impact
+# and does not change the impact of the other flood maps read with it
+@pytest.mark.parametrize('backend', [{}, {'tile_cache': True}, {'memmap_store': True}, {'crop_runs': True},
+                                     {'osm_cache': True}, {'depth_column': 'Depth'}, {'supersample': 4}])
+def test_empty_flood_map(data, backend):
+    empty = data['events']['circle'].iloc[:0]
+    events = {'empty': empty, 'circle': data['events']['circle']}
+
+    impact = fd.batch_impact(events, data['crop'], data['pop'], data['osm'], **backend)
+    expected = fd.batch_impact({'circle': events['circle']}, data['crop'], data['pop'], data['osm'], **backend)
+
+    assert (impact.loc['empty'] == 0).all()
+    pd.testing.assert_frame_equal(impact.loc[['circle']], expected)
+    assert (fd.batch_impact({'empty': empty}, data['crop'], data['pop'], data['osm'], **backend) == 0).all(axis=None)
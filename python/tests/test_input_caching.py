@@ -0,0 +1,106 @@
+# Checks that the caches of the inputs are made again when any file of a dataset changes
+import glob
+import json
+import os
+
+import geopandas as gpd
+import numpy as np
+
+import fldimpact_def as fd
+
+
+# OpenStreetMap point shapefile with the same amenity for every point
+def write_osm(osm_file, amenity, n=50):
+    rng = np.random.default_rng(0)
+    osm = gpd.GeoDataFrame({'osm_id': [str(i) for i in range(n)], 'other_tags': ['"amenity"=>"%s"' % amenity] * n},
+                           geometry=gpd.points_from_xy(rng.random(n), rng.random(n)), crs='EPSG:4326')
+    osm.to_file(osm_file)
+
+
+# Retagging the points only changes the .dbf of the shapefile, so the .shp keeps the same hash
+def test_osm_cache_follows_dbf(tmp_path):
+    osm_file = str(tmp_path / 'osm.shp')
+    write_osm(osm_file, 'toilets')
+    fingerprint = fd.file_fingerprint(osm_file)
+    assert fd.read_osm_cache(fd.cache_osm(osm_file))['Amenity'].unique().tolist() == ['toilets']
+
+    write_osm(osm_file, 'hospital')
+    assert not fd.same_file(fingerprint, osm_file)
+    assert fd.read_osm_cache(fd.cache_osm(osm_file))['Amenity'].unique().tolist() == ['hospital']
+
+
+# Changing the depth of a shapefile flood map only changes its .dbf and touching it does not change it at all
+def test_incremental_follows_dbf(data, tmp_path):
+    flood_file = str(tmp_path / 'flood.shp')
+    flood_map = data['events']['overlapping']
+    flood_map.to_file(flood_file)
+
+    state_file = str(tmp_path / 'state.json')
+    options = {'workers': 1, 'depth_column': 'Depth'}
+    first = fd.incremental_impact({'flood': flood_file}, data['crop'], data['pop'], data['osm'], state_file, **options)
+
+    flood_map.assign(Depth=flood_map['Depth'] + 1).to_file(flood_file)
+    second = fd.incremental_impact({'flood': flood_file}, data['crop'], data['pop'], data['osm'], state_file, **options)
+    assert second.loc['flood', 'Population >1 m'] > first.loc['flood', 'Population >1 m']
+
+    # The modification time of a touched flood map is kept so it is not hashed again next time
+    touched = fd.file_fingerprint(flood_file, False)['mtime'] + 100
+    for filename in fd.dataset_files(flood_file):
+        os.utime(filename, (touched, touched))
+    fd.incremental_impact({'flood': flood_file}, data['crop'], data['pop'], data['osm'], state_file, **options)
+    with open(state_file) as f:
+        state = json.load(f)
+    assert state['flood_maps']['flood']['fingerprint']['mtime'] == touched
+
+
+
+# Sizes of the tiles saved in a tile cache directory by file
+def saved_tiles(cache_dir):
+    return {tile_file: os.path.getsize(tile_file) for tile_file in glob.glob(os.path.join(cache_dir, '*', '*.npy'))}
+
+
+# The tile cache directory keeps at most exposure_tile_disk_bytes of tiles by deleting the least recently used ones
+def test_tile_cache_disk_cap(data, tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / 'tiles')
+    flood_map = data['events']['multipolygon']
+    # The tiles kept in memory are replaced for the test only
+    monkeypatch.setattr(fd, 'exposure_tiles', {})
+    expected = fd.read_exposure_tiles(data['crop'], [flood_map], 'crop', cache_dir=cache_dir)['array']
+    crop_tiles = saved_tiles(cache_dir)
+    for tile_file in crop_tiles:
+        os.utime(tile_file, (1e9, 1e9))
+
+    fd.read_exposure_tiles(data['pop'], [flood_map], 'pop', cache_dir=cache_dir)
+    pop_tiles = {tile_file: size for tile_file, size in saved_tiles(cache_dir).items() if tile_file not in crop_tiles}
+    assert crop_tiles and pop_tiles
+
+    # The croplands tiles were used less recently than the population tiles
+    monkeypatch.setattr(fd, 'exposure_tile_disk_bytes', sum(pop_tiles.values()))
+    fd.evict_exposure_tiles(cache_dir)
+    assert saved_tiles(cache_dir) == pop_tiles
+
+    # Evicted tiles are read from the raster again and saving them evicts the population tiles
+    monkeypatch.setattr(fd, 'exposure_tiles', {})
+    array = fd.read_exposure_tiles(data['crop'], [flood_map], 'crop', cache_dir=cache_dir)['array']
+    np.testing.assert_array_equal(array, expected)
+    assert sum(saved_tiles(cache_dir).values()) <= sum(pop_tiles.values())
+
+
+# The catalog describes each flood map like reading it whole does and reads it again when it changes
+def test_catalog_describes_flood_maps(tmp_path, data):
+    events = data['events']
+    for name in ('overlapping', 'utm'):
+        events[name].to_file(str(tmp_path / (name + '.geojson')))
+
+    catalog = fd.catalog_flood_maps(str(tmp_path))
+    for name in ('overlapping', 'utm'):
+        entry = catalog[str(tmp_path / (name + '.geojson'))]
+        assert np.allclose(entry['bounds'], events[name].total_bounds)
+        assert entry['count'] == len(events[name])
+        assert entry['schema']['geometry'] == 'Polygon'
+        assert entry['min'] == {'Depth': events[name]['Depth'].min()}
+        assert entry['max'] == {'Depth': events[name]['Depth'].max()}
+
+    events['circle'].to_file(str(tmp_path / 'overlapping.geojson'))
+    assert fd.catalog_max(fd.catalog_flood_maps(str(tmp_path)), 'Depth') == {
+        str(tmp_path / 'overlapping.geojson'): 0.3, str(tmp_path / 'utm.geojson'): 1.2}
@@ -0,0 +1,25 @@
+# Checks that each stage records the peak RSS reached while it ran, including the stages it runs in
+import numpy as np
+import pytest
+
+import fldimpact_def as fd
+
+
+@pytest.mark.skipif(fd.rss_column != 'Peak RSS (MB)', reason='the high-water mark of the RSS cannot be reset')
+def test_stage_peak_rss():
+    fd.start_profiling()
+    try:
+        with fd.profile_stage('outer'):
+            with fd.profile_stage('spike'):
+                spike = np.ones(2 ** 25)
+                del spike
+            with fd.profile_stage('small'):
+                pass
+    finally:
+        profile = fd.stop_profiling().set_index('Stage')
+
+    # The 256 MB array is freed before the stage ends, so only its peak shows it
+    peak = profile[fd.rss_column]
+    assert peak['spike'] - peak['small'] > 200
+    assert peak['outer'] == peak['spike']
+    assert abs(profile.loc['spike', 'RSS Change (MB)']) < 50